@@ -2,58 +2,828 @@ import time
 import os
 import re
 import json
+import hashlib
 import ast
 import random
-from google import genai
-from google.genai import types
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+import shutil
+import subprocess
+import tempfile
+import http.client
+import argparse
+import threading
+import socket
+import sqlite3
+import signal
+import unicodedata
+import itertools
+import statistics
+import datetime
+import zoneinfo
+import contextlib
+import functools
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 import uuid
-from moviepy.editor import VideoFileClip, AudioFileClip, CompositeAudioClip
-import google.oauth2.credentials
-import google.auth.transport.requests
+# google-genai, the Google API client libraries, numpy and moviepy take seconds
+# to import, so they are imported inside the functions that use them. Commands
+# that never render, upload or re-encode don't pay for them.
 
 # Define YouTube OAuth 2.0 scopes
 SCOPES = ['https://www.googleapis.com/auth/youtube']
 
-# File to store used prompts/food items
+# OAuth client configuration and the file caching the user's authorized token
+CLIENT_SECRETS_FILE = "client_secrets.json"
+YOUTUBE_TOKEN_FILE = os.getenv("YOUTUBE_TOKEN_FILE", "token.json")
+
+# Store of used prompts/food items. The JSON file is the legacy format and is
+# imported into the database once.
+USED_PROMPTS_DB = "used_prompts.db"
 USED_PROMPTS_FILE = "used_prompts.json"
 VIDEOS_OUTPUT_FOLDER = "generated_videos"  # Folder to save all generated videos
+JOBS_FOLDER = "jobs"  # Per-job checkpoints used by --resume
+# A job checkpointed as running more recently than this is taken to be in
+# progress in another process, so --resume leaves it alone
+JOB_RUNNING_STALE_SECONDS = 30 * 60
+
+# Content-addressed video storage: files live at objects/<sha[:2]>/<sha>.mp4 and an
+# index maps jobs to them. Least recently used files are evicted beyond the size
+# cap, and raw Veo clips are dropped after upload unless KEEP_RAW_CLIPS=1.
+ARTIFACT_STORE_FOLDER = os.path.join(VIDEOS_OUTPUT_FOLDER, "objects")
+ARTIFACT_INDEX_DB = os.path.join(VIDEOS_OUTPUT_FOLDER, "artifacts.db")
+ARTIFACT_STORE_MAX_BYTES = int(float(os.getenv("ARTIFACT_STORE_MAX_GB", "20")) * 1024 ** 3)
+KEEP_RAW_CLIPS = os.getenv("KEEP_RAW_CLIPS", "0") == "1"
+
+# Background music: source tracks, cache of decoded segments and mix settings
+MUSIC_TRACKS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "music_tracks")
+MUSIC_CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".music_cache")
+MUSIC_VOLUME = 0.3
+MUSIC_SAMPLE_RATE = 44100
+MUSIC_CHANNELS = 2
+# Music encode processes are not forked: by the time they start, the poller and job
+# threads may hold the stdout, metrics or SQLite locks, which a forked child inherits locked
+MUSIC_POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Length of every generated video in seconds
+VIDEO_DURATION_SECONDS = 8
+
+# ffmpeg executable used to mux music without re-encoding the video
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+# YouTube uploads: chunk size (a multiple of 256 KiB), retry policy and the file
+# holding resumable session URIs of unfinished uploads
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+UPLOAD_MAX_RETRIES = 8
+UPLOAD_MAX_BACKOFF = 64  # seconds
+UPLOAD_RETRY_STATUS_CODES = (500, 502, 503, 504)
+UPLOAD_RETRY_EXCEPTIONS = (http.client.HTTPException, OSError)  # httplib2.HttpLib2Error is added in upload_video
+UPLOAD_SESSIONS_FILE = "upload_sessions.json"
+UPLOAD_SESSION_MAX_AGE = 6 * 24 * 3600  # YouTube keeps resumable sessions for about a week
+
+# Optional cache of Gemini text responses: off, cache, record or replay
+GENAI_CACHE_MODE = os.getenv("GENAI_CACHE_MODE", "off")
+GENAI_CACHE_FOLDER = ".genai_cache"
+GENAI_CACHE_TTL = 7 * 24 * 3600  # seconds
+GENAI_CACHE_MAX_ENTRIES = 1000
+
+# Response schema for the metadata call, so Gemini returns plain JSON
+METADATA_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "title": {"type": "STRING"},
+        "description": {"type": "STRING"},
+        "keywords": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["title", "description", "keywords"],
+    "propertyOrdering": ["title", "description", "keywords"],
+}
+
+# Number of videos worked on at once in batch mode
+DEFAULT_BATCH_CONCURRENCY = 2
+
+# Idea generation: candidates requested per Gemini call, how many recent items
+# are listed in the prompt as exclusions, and calls made before giving up
+IDEA_CANDIDATES = 3
+IDEA_EXCLUSION_LIMIT = 50
+IDEA_MAX_ATTEMPTS = 2
+
+# Polling of pending Veo renders (seconds). The first check happens at the expected
+# render time, learned from recently finished renders; after that, checks back off
+# but never get further apart than the old fixed 20 s sleep.
+VEO_POLL_MIN_INTERVAL = 5
+VEO_POLL_MAX_INTERVAL = 20
+VEO_POLL_DEFAULT_ESTIMATE = 60
+VEO_POLL_MAX_ERRORS = 5  # Consecutive polling failures before a render is given up
+
+# Per-minute request limits, each enforced by a token bucket so calls wait
+# instead of being rejected with 429. Set them to the quotas of your project.
+API_RATE_LIMITS = {
+    "gemini": float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", 15)),
+    "veo": float(os.getenv("VEO_REQUESTS_PER_MINUTE", 2)),
+    "youtube": float(os.getenv("YOUTUBE_REQUESTS_PER_MINUTE", 10)),
+}
+RATE_LIMIT_MAX_RETRIES = 5  # 429 responses retried with backoff before giving up
+
+# YouTube Data API quota: units per day, the cost of one videos().insert and
+# the database tracking usage per day, shared by every process in this directory
+# (plus the JSON file it replaced). The quota resets at midnight Pacific time.
+YOUTUBE_DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", 10000))
+YOUTUBE_UPLOAD_COST = 1600
+YOUTUBE_QUOTA_DB = "youtube_quota.db"
+YOUTUBE_QUOTA_FILE = "youtube_quota.json"
+YOUTUBE_QUOTA_TIMEZONE = zoneinfo.ZoneInfo("America/Los_Angeles")
+
+# Worker mode: durable queue of video requests, how often an idle worker checks
+# it, how many requests may wait before enqueue refuses more, and how often a
+# failing request is tried (waiting WORKER_RETRY_DELAY seconds times the attempt).
+# A worker holds a lease on the requests it runs and renews it every quarter
+# of WORKER_LEASE_SECONDS; requests whose lease ran out go back to the queue.
+JOB_QUEUE_DB = "job_queue.db"
+WORKER_POLL_INTERVAL = 5  # seconds
+WORKER_MAX_QUEUED = 100
+WORKER_MAX_ATTEMPTS = 3
+WORKER_RETRY_DELAY = 300
+WORKER_LEASE_SECONDS = 120
+
+# Stages run by the idea, render and upload subcommands
+COMMAND_STAGES = {
+    "idea": ("idea", "metadata"),
+    "render": ("music_track", "render", "music"),
+    "upload": ("auth", "upload"),
+}
+
+# Metrics: every finished stage is appended to the JSON lines file, and totals are
+# written to the Prometheus textfile at the end of a run. An empty path disables either.
+METRICS_EVENTS_FILE = os.getenv("METRICS_EVENTS_FILE", "metrics.jsonl")
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", "metrics.prom")
+METRICS_PREFIX = "youtubeai"
+
+class Metrics:
+    """
+    Stage timings and counters for one process.
+
+    Totals are kept in memory under a lock, so recording costs a dict update.
+    Finished spans are also appended to events_file as JSON lines while the run
+    goes on; export() writes the totals to prometheus_file in the text format
+    read by node_exporter's textfile collector.
+    """
+
+    # Help text of the counters the pipeline records
+    COUNTERS = {
+        "retries_total": "Retried API calls by operation.",
+        "parse_fallbacks_total": "Responses that needed the lenient parser.",
+        "used_item_collisions_total": "Generated food items that were already used.",
+        "upload_bytes_total": "Bytes sent to YouTube.",
+        "encode_seconds_total": "Seconds spent adding music to videos.",
+        "streaming_mux_total": "Music muxes done while downloading, by result.",
+        "genai_cache_requests_total": "Gemini text requests by cache result.",
+        "rate_limit_wait_seconds_total": "Seconds calls waited for a rate limit token by API.",
+        "jobs_total": "Finished jobs by status.",
+        "artifacts_total": "Video files handled by the artifact store, by result.",
+    }
+
+    def __init__(self, events_file=METRICS_EVENTS_FILE, prometheus_file=METRICS_PROMETHEUS_FILE):
+        self.events_file = events_file
+        self.prometheus_file = prometheus_file
+        self._counters = {}  # (name, labels) -> value
+        self._spans = {}  # (stage, status) -> [count, total seconds]
+        self._events = None
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        """Add `amount` to a counter. Labels should have few distinct values."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def span(self, stage, job=None):
+        """Time the enclosed block as one run of `stage`, recording whether it raised."""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.record_span(stage, time.perf_counter() - start, status, job)
+
+    def record_span(self, stage, seconds, status="ok", job=None):
+        event = {"ts": round(time.time(), 3), "stage": stage, "seconds": round(seconds, 4), "status": status}
+        if job:
+            event["job"] = job
+        with self._lock:
+            totals = self._spans.setdefault((stage, status), [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            self._write_event(event)
+
+    def counters(self):
+        """Current counter values as {"name{label=value}": value}."""
+        with self._lock:
+            return {_metric_key(name, labels): value for (name, labels), value in sorted(self._counters.items())}
+
+    def _write_event(self, event):
+        if not self.events_file:
+            return
+        if self._events is None:
+            self._events = open(self.events_file, 'a', buffering=1)  # Line buffered
+        self._events.write(json.dumps(event) + "\n")
+
+    def export(self):
+        """Write the counter totals as a JSON line and all totals to the Prometheus textfile."""
+        counters = self.counters()
+        with self._lock:
+            if counters:
+                self._write_event({"ts": round(time.time(), 3), "counters": counters})
+            spans = sorted(self._spans.items())
+            counter_items = sorted(self._counters.items())
+        if not self.prometheus_file:
+            return
+
+        lines = [
+            f"# HELP {METRICS_PREFIX}_stage_seconds Time spent in each pipeline stage.",
+            f"# TYPE {METRICS_PREFIX}_stage_seconds summary",
+        ]
+        for (stage, status), (count, seconds) in spans:
+            labels = (("stage", stage), ("status", status))
+            lines.append(f"{_metric_key(METRICS_PREFIX + '_stage_seconds_sum', labels)} {seconds:.6f}")
+            lines.append(f"{_metric_key(METRICS_PREFIX + '_stage_seconds_count', labels)} {count}")
+        described = set()
+        for (name, labels), value in counter_items:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {METRICS_PREFIX}_{name} {self.COUNTERS.get(name, name)}")
+                lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+            lines.append(f"{_metric_key(f'{METRICS_PREFIX}_{name}', labels)} {value:g}")
+
+        # Replace the file in one step so the collector never reads a partial file
+        temp_path = f"{self.prometheus_file}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.prometheus_file)
+
+    def close(self):
+        with self._lock:
+            if self._events is not None:
+                self._events.close()
+                self._events = None
+
+
+def _metric_key(name, labels):
+    """Format a metric name and (key, value) label pairs in Prometheus notation."""
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# Metrics of this process, exported at the end of every batch
+metrics = Metrics()
+
+# Process-wide YouTube client, built lazily by get_youtube_client()
+_youtube_client = None
+_youtube_client_lock = threading.Lock()
+
+# Token buckets per API, created lazily by get_rate_limiter()
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+# Process-wide YouTube quota tracker, created lazily by get_youtube_quota()
+_youtube_quota = None
+_youtube_quota_lock = threading.Lock()
+
+# Guards read-modify-write of the upload sessions file
+_upload_sessions_lock = threading.Lock()
+
+# Process-wide music library, created lazily by get_music_library()
+_music_library = None
+_music_library_lock = threading.Lock()
+
+# Process-wide used item store, opened lazily by get_used_item_store()
+_used_item_store = None
+_used_item_store_lock = threading.Lock()
+
+# Process-wide artifact store, opened lazily by get_artifact_store()
+_artifact_store = None
+_artifact_store_lock = threading.Lock()
 
 
 def create_output_folder():
     """Create the output folder for generated videos if it doesn't exist."""
     if not os.path.exists(VIDEOS_OUTPUT_FOLDER):
-        os.makedirs(VIDEOS_OUTPUT_FOLDER)
+        os.makedirs(VIDEOS_OUTPUT_FOLDER, exist_ok=True)
         print(f"Created output folder: {VIDEOS_OUTPUT_FOLDER}")
     return VIDEOS_OUTPUT_FOLDER
 
 
+def normalize_item_name(name):
+    """Normalize an item name so that e.g. "Matcha Latte" and "matcha latte!" compare equal."""
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(c for c in name if not unicodedata.combining(c)).casefold()
+    name = re.sub(r"['\u2019]", '', name)
+    name = re.sub(r'[^\w\s]|_', ' ', name)
+    return re.sub(r'\s+', ' ', name).strip()
+
+
+class UsedItemStore:
+    """
+    SQLite-backed record of used food items, indexed by normalized name.
+
+    Membership checks are a single primary-key lookup and adding an item is one
+    INSERT, so nothing is rewritten per video. SQLite's locking keeps concurrent
+    writers (threads or separate processes) from losing each other's items.
+    Items from the legacy JSON file are imported once when the store is created.
+    """
+
+    def __init__(self, path=USED_PROMPTS_DB, legacy_json=USED_PROMPTS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS used_items ("
+                "key TEXT PRIMARY KEY, name TEXT NOT NULL, created_at REAL NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_json:
+            self._import_legacy_json(legacy_json)
+
+    def _import_legacy_json(self, legacy_json):
+        """Copy items from the old used_prompts.json the first time the store sees it."""
+        if not os.path.exists(legacy_json):
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                done = self._conn.execute(
+                    "SELECT 1 FROM store_meta WHERE key = 'imported_json'").fetchone()
+                if not done:
+                    with open(legacy_json, 'r') as f:
+                        items = json.load(f)
+                    now = time.time()
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO used_items (key, name, created_at) VALUES (?, ?, ?)",
+                        [(normalize_item_name(item), item, now) for item in items])
+                    self._conn.execute(
+                        "INSERT INTO store_meta (key, value) VALUES ('imported_json', ?)", (legacy_json,))
+                    print(f"Imported {len(items)} used items from {legacy_json} into {self.path}")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def __contains__(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM used_items WHERE key = ?", (normalize_item_name(name),)).fetchone()
+        return row is not None
+
+    def add(self, name):
+        """Record an item as used. Returns False if it (or an equivalent spelling) was already there."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO used_items (key, name, created_at) VALUES (?, ?, ?)",
+                (normalize_item_name(name), name, time.time()))
+        return cursor.rowcount == 1
+
+    def recent(self, limit):
+        """The `limit` most recently added items, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name FROM used_items ORDER BY rowid DESC LIMIT ?", (limit,)).fetchall()
+        return [row[0] for row in rows]
+
+    def names(self):
+        """All used items in the order they were added."""
+        with self._lock:
+            rows = self._conn.execute("SELECT name FROM used_items ORDER BY rowid").fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_used_item_store():
+    """Return the process-wide UsedItemStore, opening it on first use."""
+    global _used_item_store
+    with _used_item_store_lock:
+        if _used_item_store is None:
+            _used_item_store = UsedItemStore()
+        return _used_item_store
+
+
+class ArtifactStore:
+    """
+    Content-addressed storage for generated videos, indexed in SQLite.
+
+    put() moves a file to objects/<sha[:2]>/<sha>.mp4, so identical files are
+    kept once however many jobs produce them, and records it as an artifact of
+    a job under a kind such as "raw" or "music". An object is deleted as soon
+    as no artifact refers to it. When the objects add up to more than
+    max_bytes, the least recently stored or looked-up ones are evicted along
+    with their artifacts.
+    """
+
+    def __init__(self, root=ARTIFACT_STORE_FOLDER, path=ARTIFACT_INDEX_DB, max_bytes=ARTIFACT_STORE_MAX_BYTES):
+        self.root = root
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS objects ("
+                "sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS artifacts ("
+                "job_id TEXT NOT NULL, kind TEXT NOT NULL, sha256 TEXT NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (job_id, kind))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS artifacts_sha256 ON artifacts (sha256)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], f"{sha256}.mp4")
+
+    def put(self, path, job_id, kind, sha256=None):
+        """
+        Move an MP4 into the store as the `kind` artifact of a job and return its new path.
+
+        If the store already holds the same content, `path` is deleted and the
+        existing object is used. sha256 skips hashing when the caller already has it.
+        """
+        sha256 = sha256 or _file_digest(path, "sha256")
+        stored = self.object_path(sha256)
+        now = time.time()
+        with self._transaction() as conn:
+            known = conn.execute("SELECT 1 FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+            deduplicated = bool(known) and os.path.exists(stored)
+            if deduplicated:
+                if os.path.abspath(path) != os.path.abspath(stored):
+                    os.remove(path)
+            else:
+                os.makedirs(os.path.dirname(stored), exist_ok=True)
+                os.replace(path, stored)
+            conn.execute("INSERT OR REPLACE INTO objects (sha256, size, created_at, last_used) VALUES "
+                         "(?, ?, COALESCE((SELECT created_at FROM objects WHERE sha256 = ?), ?), ?)",
+                         (sha256, os.path.getsize(stored), sha256, now, now))
+            previous = conn.execute("SELECT sha256 FROM artifacts WHERE job_id = ? AND kind = ?",
+                                    (job_id, kind)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO artifacts (job_id, kind, sha256, created_at) VALUES (?, ?, ?, ?)",
+                         (job_id, kind, sha256, now))
+            if previous and previous[0] != sha256:
+                self._drop_unreferenced(conn, previous[0])
+        metrics.increment("artifacts_total", result="deduplicated" if deduplicated else "stored")
+        self.enforce_limit(keep={sha256})
+        return stored
+
+    def get(self, job_id, kind):
+        """Path of a job's artifact, or None. Counts as a use for LRU eviction."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT sha256 FROM artifacts WHERE job_id = ? AND kind = ?", (job_id, kind)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE objects SET last_used = ? WHERE sha256 = ?", (time.time(), row[0]))
+        return self.object_path(row[0])
+
+    def artifacts(self, job_id):
+        """All artifacts of a job as {kind: path}."""
+        with self._lock:
+            rows = self._conn.execute("SELECT kind, sha256 FROM artifacts WHERE job_id = ? ORDER BY created_at",
+                                      (job_id,)).fetchall()
+        return {kind: self.object_path(sha256) for kind, sha256 in rows}
+
+    def release(self, job_id, kind):
+        """Forget a job's artifact, deleting its file if no other artifact uses it. Returns bytes freed."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT sha256 FROM artifacts WHERE job_id = ? AND kind = ?", (job_id, kind)).fetchone()
+            if row is None:
+                return 0
+            conn.execute("DELETE FROM artifacts WHERE job_id = ? AND kind = ?", (job_id, kind))
+            freed = self._drop_unreferenced(conn, row[0])
+        metrics.increment("artifacts_total", result="released")
+        return freed
+
+    def _drop_unreferenced(self, conn, sha256):
+        if conn.execute("SELECT 1 FROM artifacts WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone():
+            return 0
+        return self._delete_object(conn, sha256)
+
+    def _delete_object(self, conn, sha256):
+        row = conn.execute("SELECT size FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        conn.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+        try:
+            os.remove(self.object_path(sha256))
+        except FileNotFoundError:
+            pass
+        return row[0] if row else 0
+
+    def enforce_limit(self, max_bytes=None, keep=()):
+        """Evict least recently used objects, except those in `keep`, until the store fits in max_bytes."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = []
+        with self._transaction() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+            if total <= max_bytes:
+                return evicted
+            for sha256, size in conn.execute("SELECT sha256, size FROM objects ORDER BY last_used").fetchall():
+                if total <= max_bytes:
+                    break
+                if sha256 in keep:
+                    continue
+                jobs = [row[0] for row in conn.execute("SELECT DISTINCT job_id FROM artifacts WHERE sha256 = ?",
+                                                       (sha256,))]
+                conn.execute("DELETE FROM artifacts WHERE sha256 = ?", (sha256,))
+                total -= self._delete_object(conn, sha256)
+                evicted.append((sha256, jobs))
+        for sha256, jobs in evicted:
+            print(f"Evicted {sha256[:12]} (jobs {', '.join(jobs) or 'none'}) to stay under "
+                  f"{max_bytes / 1024 ** 3:.1f} GB")
+        if evicted:
+            metrics.increment("artifacts_total", len(evicted), result="evicted")
+        return evicted
+
+    def usage(self):
+        """(object count, total bytes) of the store."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_artifact_store():
+    """Return the process-wide ArtifactStore, opening it on first use."""
+    global _artifact_store
+    with _artifact_store_lock:
+        if _artifact_store is None:
+            _artifact_store = ArtifactStore()
+        return _artifact_store
+
+
 def load_used_prompts():
-    """Load previously used prompts/food items from a file."""
-    if os.path.exists(USED_PROMPTS_FILE):
-        with open(USED_PROMPTS_FILE, 'r') as f:
-            return json.load(f)
-    return []
+    """Load previously used prompts/food items from the used item store."""
+    return get_used_item_store().names()
 
 
 def save_used_prompt(food_item):
-    """Save a new food item to the used prompts file."""
-    used_prompts = load_used_prompts()
-    if food_item not in used_prompts:
-        used_prompts.append(food_item)
-        with open(USED_PROMPTS_FILE, 'w') as f:
-            json.dump(used_prompts, f, indent=2)
+    """Save a new food item to the used item store."""
+    get_used_item_store().add(food_item)
+
+
+def load_youtube_credentials():
+    """
+    Return OAuth credentials for YouTube, from the token file when possible.
+
+    Saved credentials are refreshed without user interaction when they have
+    expired; the browser consent flow only runs when there is no usable token.
+    """
+    import google.auth.exceptions
+    import google.auth.transport.requests
+    import google.oauth2.credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    credentials = None
+    if os.path.exists(YOUTUBE_TOKEN_FILE):
+        credentials = google.oauth2.credentials.Credentials.from_authorized_user_file(YOUTUBE_TOKEN_FILE, SCOPES)
+        if credentials.valid:
+            return credentials
+        if credentials.expired and credentials.refresh_token:
+            try:
+                credentials.refresh(google.auth.transport.requests.Request())
+            except google.auth.exceptions.RefreshError as e:
+                print(f"Saved YouTube token could not be refreshed, signing in again: {e}")
+                credentials = None
+        else:
+            credentials = None
+
+    if credentials is None:
+        # Set up OAuth 2.0 flow
+        flow = InstalledAppFlow.from_client_secrets_file(
+            CLIENT_SECRETS_FILE, SCOPES)
+        credentials = flow.run_local_server(port=0)
+
+    # The token grants channel access, so keep it readable by this user only
+    fd = os.open(YOUTUBE_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(credentials.to_json())
+    return credentials
 
 
 def authenticate_youtube():
-    # Set up OAuth 2.0 flow
-    flow = InstalledAppFlow.from_client_secrets_file(
-        'client_secrets.json', SCOPES)
-    credentials = flow.run_local_server(port=0)
+    """
+    Build an authenticated YouTube API client that is safe to share between threads.
+
+    The client is built from the discovery document bundled with
+    google-api-python-client, so no request is made to fetch it.
+    """
+    import google_auth_httplib2
+    import googleapiclient.http
+    import httplib2
+    from googleapiclient.discovery import build
+
+    credentials = load_youtube_credentials()
+
+    # httplib2.Http is not thread-safe, so give every request its own connection
+    def build_request(http, *args, **kwargs):
+        authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        return googleapiclient.http.HttpRequest(authorized_http, *args, **kwargs)
+
     # Build the YouTube API client
-    return build('youtube', 'v3', credentials=credentials)
+    return build('youtube', 'v3', credentials=credentials, requestBuilder=build_request, static_discovery=True)
+
+
+def get_youtube_client():
+    """Return the process-wide YouTube client, authenticating on first use."""
+    global _youtube_client
+    with _youtube_client_lock:
+        if _youtube_client is None:
+            _youtube_client = authenticate_youtube()
+        return _youtube_client
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate_per_minute` calls with bursts of up to ten seconds' worth.
+
+    acquire() reserves a token and sleeps until it is due, so waiting callers
+    are served in the order they arrived.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or max(1.0, rate_per_minute / 6)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until it is available. Returns the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def get_rate_limiter(api):
+    """Return the TokenBucket for an API named in API_RATE_LIMITS."""
+    with _rate_limiters_lock:
+        if api not in _rate_limiters:
+            _rate_limiters[api] = TokenBucket(API_RATE_LIMITS[api])
+        return _rate_limiters[api]
+
+
+def wait_for_rate_limit(api):
+    """Block until the next call to `api` is allowed, recording any wait in the metrics."""
+    delay = get_rate_limiter(api).acquire()
+    if delay > 0:
+        metrics.increment("rate_limit_wait_seconds_total", delay, api=api)
+
+
+class QuotaExhausted(Exception):
+    """The YouTube daily quota cannot cover another upload until it resets."""
+
+    def __init__(self, resets_at):
+        self.resets_at = resets_at
+        reset_time = datetime.datetime.fromtimestamp(resets_at).strftime('%Y-%m-%d %H:%M')
+        super().__init__(f"YouTube daily quota used up, resets at {reset_time}")
+
+
+class YouTubeQuota:
+    """
+    Units of the YouTube daily quota spent per day, kept in SQLite.
+
+    Every upload reserves its cost before it starts. Each change is one
+    IMMEDIATE transaction, so a worker, a CLI upload and a batch running side
+    by side never overwrite each other's reservations. The count starts over
+    when the quota day (Pacific time) changes. Today's usage from the legacy
+    JSON file is imported once.
+    """
+
+    def __init__(self, path=YOUTUBE_QUOTA_DB, daily_limit=YOUTUBE_DAILY_QUOTA, legacy_json=YOUTUBE_QUOTA_FILE):
+        self.path = path
+        self.daily_limit = daily_limit
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS quota_usage (day TEXT PRIMARY KEY, used INTEGER NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)")
+        if legacy_json:
+            self._import_legacy_json(legacy_json)
+
+    def _import_legacy_json(self, legacy_json):
+        """Carry today's usage over from the old youtube_quota.json the first time the store sees it."""
+        if not os.path.exists(legacy_json):
+            return
+        with self._transaction() as conn:
+            done = conn.execute("SELECT 1 FROM store_meta WHERE key = 'imported_json'").fetchone()
+            if not done:
+                with open(legacy_json, 'r') as f:
+                    state = json.load(f)
+                if state.get("day") == self._today():
+                    day = state["day"]
+                    self._set_used(conn, day, max(self._used(conn, day), int(state.get("used", 0))))
+                conn.execute("INSERT INTO store_meta (key, value) VALUES ('imported_json', ?)", (legacy_json,))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.now(YOUTUBE_QUOTA_TIMEZONE).date().isoformat()
+
+    def _used(self, conn, day):
+        row = conn.execute("SELECT used FROM quota_usage WHERE day = ?", (day,)).fetchone()
+        return row[0] if row else 0
+
+    def _set_used(self, conn, day, used):
+        conn.execute("INSERT OR REPLACE INTO quota_usage (day, used) VALUES (?, ?)", (day, used))
+
+    def remaining(self):
+        with self._lock:
+            return max(0, self.daily_limit - self._used(self._conn, self._today()))
+
+    def resets_at(self):
+        """Unix time of the next midnight Pacific time."""
+        tomorrow = datetime.datetime.now(YOUTUBE_QUOTA_TIMEZONE).date() + datetime.timedelta(days=1)
+        return datetime.datetime.combine(tomorrow, datetime.time(), YOUTUBE_QUOTA_TIMEZONE).timestamp()
+
+    def reserve(self, units):
+        """Record `units` as spent if today's quota still covers them. Returns False otherwise."""
+        day = self._today()
+        with self._transaction() as conn:
+            used = self._used(conn, day)
+            if used + units > self.daily_limit:
+                return False
+            self._set_used(conn, day, used + units)
+            return True
+
+    def release(self, units):
+        """Give back `units` reserved today for an upload that never went through."""
+        day = self._today()
+        with self._transaction() as conn:
+            self._set_used(conn, day, max(0, self._used(conn, day) - units))
+
+    def exhaust(self):
+        """Mark today's quota as used up, e.g. after YouTube itself reported quotaExceeded."""
+        day = self._today()
+        with self._transaction() as conn:
+            self._set_used(conn, day, max(self.daily_limit, self._used(conn, day)))
+
+    def wait_and_reserve(self, units):
+        """Reserve `units`, sleeping until the quota resets for as long as it cannot cover them."""
+        while not self.reserve(units):
+            delay = self.resets_at() - time.time() + 60  # A minute of slack past midnight
+            print(f"YouTube quota used up, waiting {delay / 3600:.1f}h for it to reset")
+            time.sleep(min(delay, 3600))
+
+
+def get_youtube_quota():
+    """Return the process-wide YouTubeQuota, creating it on first use."""
+    global _youtube_quota
+    with _youtube_quota_lock:
+        if _youtube_quota is None:
+            _youtube_quota = YouTubeQuota(YOUTUBE_QUOTA_DB, YOUTUBE_DAILY_QUOTA)
+        return _youtube_quota
+
+
+def print_quota_status():
+    """Print the remaining YouTube quota and when it resets."""
+    quota = get_youtube_quota()
+    remaining = quota.remaining()
+    reset_time = datetime.datetime.fromtimestamp(quota.resets_at()).strftime('%Y-%m-%d %H:%M')
+    print(f"YouTube quota: {remaining}/{quota.daily_limit} units left today "
+          f"({remaining // YOUTUBE_UPLOAD_COST} uploads), resets at {reset_time}")
 
 
 def clean_keywords_for_youtube(keywords):
@@ -111,8 +881,66 @@ def clean_keywords_for_youtube(keywords):
     return cleaned_keywords
 
 
-def upload_video(youtube, video_file, title, description, category_id, keywords, privacy_status):
-    """Upload a video to YouTube with metadata."""
+def _upload_session_key(video_file):
+    """Identify a file by path, size and mtime so a changed file never resumes an old session."""
+    stat = os.stat(video_file)
+    return f"{os.path.abspath(video_file)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def _load_upload_sessions():
+    if os.path.exists(UPLOAD_SESSIONS_FILE):
+        try:
+            with open(UPLOAD_SESSIONS_FILE, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable {UPLOAD_SESSIONS_FILE}")
+    return {}
+
+
+def load_upload_session(key):
+    """Return the saved resumable session URI for an upload, if it is recent enough to reuse."""
+    with _upload_sessions_lock:
+        session = _load_upload_sessions().get(key)
+    if session and time.time() - session["created_at"] < UPLOAD_SESSION_MAX_AGE:
+        return session["uri"]
+    return None
+
+
+def save_upload_session(key, uri):
+    """Persist the resumable session URI so a restarted process can continue the upload."""
+    with _upload_sessions_lock:
+        sessions = _load_upload_sessions()
+        sessions[key] = {"uri": uri, "created_at": time.time()}
+        _write_json_atomic(UPLOAD_SESSIONS_FILE, sessions)
+
+
+def clear_upload_session(key):
+    with _upload_sessions_lock:
+        sessions = _load_upload_sessions()
+        if sessions.pop(key, None) is not None:
+            _write_json_atomic(UPLOAD_SESSIONS_FILE, sessions)
+
+
+def upload_video(youtube, video_file, title, description, category_id, keywords, privacy_status,
+                 chunk_size=UPLOAD_CHUNK_SIZE, reserve_quota=None):
+    """
+    Upload a video to YouTube with metadata.
+
+    The file is sent in chunk_size pieces through a resumable session. 5xx
+    responses and connection errors are retried with exponential backoff, and
+    the session URI is saved so that a later call for the same file continues
+    where the previous process stopped instead of starting over. reserve_quota,
+    if given, is called before each new (charged) session is started, including
+    one that replaces an expired saved session. Returns the API response, or
+    None if the upload failed; raises QuotaExhausted when reserve_quota does or
+    when YouTube rejects the upload with quotaExceeded.
+    """
+    import httplib2
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import MediaFileUpload
+
+    retry_exceptions = UPLOAD_RETRY_EXCEPTIONS + (httplib2.HttpLib2Error,)
+
     # Clean the keywords first
     clean_tags = clean_keywords_for_youtube(keywords)
 
@@ -135,19 +963,85 @@ def upload_video(youtube, video_file, title, description, category_id, keywords,
     if clean_tags:
         body['snippet']['tags'] = clean_tags
 
-    media = MediaFileUpload(video_file, chunksize=-1, resumable=True)
+    media = MediaFileUpload(video_file, chunksize=chunk_size, resumable=True)
     request = youtube.videos().insert(
         part='snippet,status',
         body=body,
         media_body=media
     )
 
+    session_key = _upload_session_key(video_file)
+    saved_uri = load_upload_session(session_key)
+    if saved_uri:
+        # In the error state, next_chunk() first asks the server how much it already has
+        print(f"Resuming previous upload session for {video_file}")
+        request.resumable_uri = saved_uri
+        request._in_error_state = True
+
     try:
-        response = request.execute()
+        if not saved_uri and reserve_quota:
+            reserve_quota()
+        response = None
+        retries = 0
+        start_progress = None
+        start_time = time.monotonic()
+        while response is None:
+            error = None
+            try:
+                status, response = request.next_chunk()
+                retries = 0
+                if request.resumable_uri and request.resumable_uri != saved_uri:
+                    saved_uri = request.resumable_uri
+                    save_upload_session(session_key, saved_uri)
+                if status:
+                    if start_progress is None:
+                        start_progress = status.resumable_progress - min(chunk_size, status.resumable_progress)
+                    print(f"Uploaded {int(status.progress() * 100)}% of {video_file}")
+            except HttpError as e:
+                if e.resp.status in UPLOAD_RETRY_STATUS_CODES:
+                    error = f"HTTP {e.resp.status}"
+                elif e.resp.status in (404, 410) and saved_uri:
+                    # The saved session expired on the server side; start a new one
+                    print("Saved upload session is no longer valid, starting a new upload")
+                    clear_upload_session(session_key)
+                    saved_uri = None
+                    request.resumable_uri = None
+                    request.resumable_progress = 0
+                    request._in_error_state = False
+                    if reserve_quota:
+                        reserve_quota()
+                    continue
+                else:
+                    if e.resp.status == 403 and b'quotaExceeded' in (e.content or b''):
+                        quota = get_youtube_quota()
+                        quota.exhaust()
+                        raise QuotaExhausted(quota.resets_at()) from e
+                    raise
+            except retry_exceptions as e:
+                error = f"{type(e).__name__}: {e}"
+
+            if error:
+                retries += 1
+                if retries > UPLOAD_MAX_RETRIES:
+                    raise RuntimeError(f"Giving up after {UPLOAD_MAX_RETRIES} retries, last error: {error}")
+                delay = random.uniform(0.5, 1.0) * min(2 ** retries, UPLOAD_MAX_BACKOFF)
+                print(f"Upload interrupted ({error}), retry {retries}/{UPLOAD_MAX_RETRIES} in {delay:.1f}s")
+                metrics.increment("retries_total", operation="upload")
+                time.sleep(delay)
+
+        clear_upload_session(session_key)
+        elapsed = time.monotonic() - start_time
+        sent_bytes = media.size() - (start_progress or 0)
+        metrics.increment("upload_bytes_total", sent_bytes)
+        print(f"Upload throughput: {sent_bytes / 1e6:.1f} MB in {elapsed:.1f}s "
+              f"({sent_bytes / max(elapsed, 1e-6) / 1e6:.2f} MB/s)")
+
         video_id = response['id']
         print(f"Video uploaded successfully! Video ID: {video_id}")
         print(f"Video URL: https://www.youtube.com/watch?v={video_id}")
         return response
+    except QuotaExhausted:
+        raise
     except Exception as e:
         print(f"Upload failed: {e}")
         return None
@@ -160,97 +1054,190 @@ def sanitize_filename(food_item):
     return sanitized[:50]
 
 
-def parse_metadata(metadata_text):
-    """Parse metadata with improved JSON handling and validation."""
-    print(f"Raw metadata: {metadata_text}")
-    metadata_text = metadata_text.strip()
+class _LenientJSONParser:
+    """
+    Single-pass, forgiving JSON reader for model output that json.loads rejects.
 
-    # Extract JSON from code block
-    json_match = re.search(r'```json\s*(\{.*?\})\s*```', metadata_text, re.DOTALL)
-    if not json_match:
-        raise ValueError("No JSON code block found. Metadata must be wrapped in ```json ... ```")
+    Handles the usual ways generated JSON breaks: unescaped double quotes inside
+    strings (a quote only closes a string when it is followed by structure),
+    raw newlines in strings, single-quoted strings, unquoted keys and values,
+    missing or trailing commas, and output truncated by the token limit
+    (open strings, arrays and objects are closed at end of input).
+    """
 
-    json_str = json_match.group(1).strip()
+    _ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\', '/': '/'}
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self._containers = []  # '{' or '[' for each open container
+
+    def parse(self):
+        return self._value()
+
+    def _skip_whitespace(self):
+        while self.pos < len(self.text) and self.text[self.pos].isspace():
+            self.pos += 1
+
+    def _value(self):
+        self._skip_whitespace()
+        if self.pos >= len(self.text):
+            return None
+        char = self.text[self.pos]
+        if char == '{':
+            return self._object()
+        if char == '[':
+            return self._array()
+        if char in '"\'':
+            return self._string(char)
+        return self._bare('},]\n')
+
+    def _object(self):
+        self.pos += 1
+        self._containers.append('{')
+        result = {}
+        while True:
+            self._skip_separators()
+            # Any closing bracket ends the open container, even a mismatched one
+            if self.pos >= len(self.text) or self.text[self.pos] in '}]':
+                self.pos += 1
+                self._containers.pop()
+                return result
+            start = self.pos
+            char = self.text[self.pos]
+            key = self._string(char) if char in '"\'' else self._bare(':},]\n')
+            self._skip_whitespace()
+            if self.pos < len(self.text) and self.text[self.pos] == ':':
+                self.pos += 1
+            result[str(key)] = self._value()
+            if self.pos == start:
+                self.pos += 1  # Nothing was consumed; skip the character so parsing always ends
+
+    def _array(self):
+        self.pos += 1
+        self._containers.append('[')
+        result = []
+        while True:
+            self._skip_separators()
+            if self.pos >= len(self.text) or self.text[self.pos] in ']}':
+                self.pos += 1
+                self._containers.pop()
+                return result
+            start = self.pos
+            result.append(self._value())
+            if self.pos == start:
+                self.pos += 1
+
+    def _skip_separators(self):
+        while self.pos < len(self.text) and (self.text[self.pos].isspace() or self.text[self.pos] == ','):
+            self.pos += 1
+
+    def _closes_string(self, index):
+        """A quote at `index` ends the string only if what follows is JSON structure."""
+        index += 1
+        start = index
+        while index < len(self.text) and self.text[index].isspace():
+            index += 1
+        if index >= len(self.text) or self.text[index] in ':}]':
+            return True
+        if self.text[index] == '"' and ('\n' in self.text[start:index] or self._containers[-1:] == ['[']):
+            return True  # Missing comma between lines or array items
+        if self.text[index] != ',':
+            return False
+        # After a comma the next token must start a new string or key, or close the container
+        index += 1
+        while index < len(self.text) and self.text[index].isspace():
+            index += 1
+        return (index >= len(self.text) or self.text[index] in '"\'}]'
+                or re.match(r'[A-Za-z_][\w-]*\s*:', self.text[index:index + 64]) is not None)
+
+    def _string(self, quote):
+        self.pos += 1
+        chars = []
+        while self.pos < len(self.text):
+            char = self.text[self.pos]
+            if char == '\\' and self.pos + 1 < len(self.text):
+                escaped = self.text[self.pos + 1]
+                if escaped == 'u' and re.match(r'[0-9a-fA-F]{4}', self.text[self.pos + 2:self.pos + 6]):
+                    chars.append(chr(int(self.text[self.pos + 2:self.pos + 6], 16)))
+                    self.pos += 6
+                    continue
+                chars.append(self._ESCAPES.get(escaped, escaped))
+                self.pos += 2
+                continue
+            if char == quote and self._closes_string(self.pos):
+                self.pos += 1
+                return ''.join(chars)
+            chars.append(char)
+            self.pos += 1
+        return ''.join(chars)  # Truncated output: keep what was generated
+
+    def _bare(self, terminators):
+        start = self.pos
+        while self.pos < len(self.text) and self.text[self.pos] not in terminators:
+            self.pos += 1
+        token = self.text[start:self.pos].strip()
+        literals = {'true': True, 'false': False, 'null': None}
+        if token in literals:
+            return literals[token]
+        try:
+            return json.loads(token)
+        except ValueError:
+            return token
 
-    print(f"Cleaned JSON string for parsing: {json_str}")
 
-    try:
-        # Try parsing the JSON directly first (should work if AI generates proper JSON)
-        metadata = json.loads(json_str)
-        title = metadata.get("title", "").strip()
-        description = metadata.get("description", "").strip()
-        keywords = metadata.get("keywords", [])
+def parse_json_leniently(text):
+    """Parse JSON-like model output that is not strictly valid JSON."""
+    return _LenientJSONParser(text).parse()
 
-        # Ensure keywords is a list
-        if isinstance(keywords, str):
-            try:
-                keywords = ast.literal_eval(keywords)
-            except:
-                keywords = [k.strip() for k in keywords.split(',')]
 
-        # Ensure all keywords are strings and clean them
-        keywords = [str(k).strip().strip('"\'') for k in keywords if k]
+def parse_metadata(metadata_text):
+    """
+    Parse the metadata response into (title, description, keywords) and validate it.
+
+    Schema-constrained responses are plain JSON and decode in one json.loads.
+    Anything else (code fences, surrounding text, broken quoting, truncation)
+    goes through the single-pass lenient parser.
+    """
+    json_str = metadata_text.strip()
+
+    # Unwrap a ```json code block, or skip any text before the object
+    fence_match = re.search(r'```(?:json)?\s*(.*?)(?:```|$)', json_str, re.DOTALL)
+    if fence_match:
+        json_str = fence_match.group(1).strip()
+    if '{' in json_str:
+        json_str = json_str[json_str.index('{'):]
 
+    try:
+        metadata = json.loads(json_str)
     except json.JSONDecodeError as e:
-        print(f"Initial JSON parsing failed: {e}")
+        print(f"Metadata is not valid JSON ({e}), using lenient parser. Raw metadata: {metadata_text}")
+        metrics.increment("parse_fallbacks_total", parser="metadata")
+        metadata = parse_json_leniently(json_str)
 
-        # Fallback parsing for malformed JSON
-        try:
-            # More careful approach to fix the JSON
-            # First, handle newlines and clean whitespace
-            clean_json = re.sub(r'\s*\n\s*', ' ', json_str)
-            clean_json = re.sub(r'\s+', ' ', clean_json)
-
-            # Fix unescaped quotes within strings (like apostrophes)
-            # This regex finds quoted strings and escapes internal quotes
-            def escape_internal_quotes(match):
-                content = match.group(1)
-                # Escape any unescaped quotes within the content
-                content = content.replace('\\"', '###ESCAPED_QUOTE###')  # Temporarily mark already escaped
-                content = content.replace('"', '\\"')  # Escape unescaped quotes
-                content = content.replace('###ESCAPED_QUOTE###', '\\"')  # Restore previously escaped
-                return f'"{content}"'
-
-            # Apply the fix to string values
-            clean_json = re.sub(r'"([^"]*(?:\\"[^"]*)*)"', escape_internal_quotes, clean_json)
-
-            # Try parsing again
-            metadata = json.loads(clean_json)
-            title = metadata.get("title", "").strip()
-            description = metadata.get("description", "").strip()
-            keywords = metadata.get("keywords", [])
-            keywords = [str(k).strip().strip('"\'') for k in keywords if k]
-
-        except json.JSONDecodeError as e2:
-            print(f"Fallback JSON parsing also failed: {e2}")
-
-            # Last resort: manual extraction using regex
-            try:
-                # Extract title
-                title_match = re.search(r'"title":\s*"([^"]*(?:\\"[^"]*)*)"', json_str)
-                title = title_match.group(1).replace('\\"', '"') if title_match else ""
-
-                # Extract description
-                desc_match = re.search(r'"description":\s*"([^"]*(?:\\"[^"]*)*)"', json_str)
-                description = desc_match.group(1).replace('\\"', '"').replace('\\n', '\n') if desc_match else ""
-
-                # Extract keywords array
-                keywords_match = re.search(r'"keywords":\s*\[(.*?)\]', json_str, re.DOTALL)
-                if keywords_match:
-                    keywords_str = keywords_match.group(1)
-                    # Extract individual keywords
-                    keyword_matches = re.findall(r'"([^"]*)"', keywords_str)
-                    keywords = [k.strip() for k in keyword_matches if k.strip()]
-                else:
-                    keywords = []
+    if not isinstance(metadata, dict) or not (metadata.get("title") or metadata.get("description")):
+        raise ValueError(f"Could not parse metadata. Raw metadata:\n{metadata_text}")
+
+    title = str(metadata.get("title") or "").strip()
+    description = str(metadata.get("description") or "").strip()
+    keywords = metadata.get("keywords") or []
 
-                print(f"Manual extraction successful: {len(keywords)} keywords found")
+    # Ensure keywords is a list
+    if isinstance(keywords, str):
+        try:
+            keywords = ast.literal_eval(keywords)
+        except (ValueError, SyntaxError):
+            keywords = [k.strip() for k in keywords.split(',')]
+        if isinstance(keywords, str):
+            keywords = [keywords]
+    if isinstance(keywords, tuple):
+        keywords = list(keywords)
+    if not isinstance(keywords, list):
+        # A number, bool or object is no usable keyword list; fall back to none
+        keywords = []
 
-            except Exception as e3:
-                raise ValueError(
-                    f"All metadata parsing methods failed. Original error: {e}. "
-                    f"Fallback error: {e2}. Manual extraction error: {e3}. "
-                    f"Raw metadata:\n{metadata_text}")
+    # Ensure all keywords are strings and clean them
+    keywords = [str(k).strip().strip('"\'') for k in keywords if k]
 
     # Truncate description to 4500 characters (YouTube limit is 5000, leaving buffer)
     if len(description) > 4500:
@@ -273,53 +1260,419 @@ def parse_metadata(metadata_text):
     return title, description, keywords
 
 
+class MusicSegment(namedtuple('MusicSegment', ['path', 'sample_rate', 'channels', 'duration'])):
+    """A pre-decoded, pre-trimmed music clip stored as raw s16le PCM with its gain already applied."""
+
+    def load_array(self):
+        """Memory-map the PCM samples as an (n_samples, channels) int16 array."""
+        import numpy as np
+
+        samples = np.memmap(self.path, dtype=np.int16, mode='r')
+        return samples.reshape(-1, self.channels)
+
+
+class MusicLibrary:
+    """
+    Index of the music_tracks folder with an on-disk cache of decoded segments.
+
+    Tracks are identified by a hash of their contents. The hash is only
+    recomputed when a file's size or mtime changes, so re-indexing an unchanged
+    folder is a handful of stat calls. Segments are decoded with ffmpeg once
+    per (track, duration, volume) and reused by every later mix; segments of
+    tracks that changed or were removed are deleted on refresh.
+    """
+
+    def __init__(self, music_dir=MUSIC_TRACKS_FOLDER, cache_dir=MUSIC_CACHE_FOLDER):
+        self.music_dir = music_dir
+        self.cache_dir = cache_dir
+        self._index_file = os.path.join(cache_dir, "index.json")
+        self._tracks = None  # path -> {"size", "mtime", "sha1"}
+        self._lock = threading.Lock()
+        self._segment_locks = {}
+
+    def refresh(self):
+        """Re-scan the music folder, hashing new or changed tracks and dropping stale segments."""
+        with self._lock:
+            self._tracks = self._build_index()
+            return sorted(self._tracks)
+
+    def tracks(self):
+        """Paths of all indexed .mp3 tracks, scanning the folder on first use."""
+        with self._lock:
+            if self._tracks is None:
+                self._tracks = self._build_index()
+            return sorted(self._tracks)
+
+    def random_track(self):
+        tracks = self.tracks()
+        return random.choice(tracks) if tracks else None
+
+    def _build_index(self):
+        if not os.path.exists(self.music_dir):
+            print(f"Warning: music_tracks directory not found at {self.music_dir}")
+            return {}
+
+        previous = {}
+        if os.path.exists(self._index_file):
+            try:
+                with open(self._index_file, 'r') as f:
+                    previous = json.load(f)
+            except (OSError, ValueError):
+                previous = {}
+
+        index = {}
+        for name in os.listdir(self.music_dir):
+            if not name.endswith('.mp3'):
+                continue
+            path = os.path.join(self.music_dir, name)
+            stat = os.stat(path)
+            entry = previous.get(path)
+            if not entry or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": _file_digest(path)}
+            index[path] = entry
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        _write_json_atomic(self._index_file, index)
+        self._prune_segments({entry["sha1"][:16] for entry in index.values()})
+        return index
+
+    def _prune_segments(self, live_hashes):
+        """Delete cached segments that belong to tracks no longer in the index."""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pcm') and name.split('_', 1)[0] not in live_hashes:
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def segment(self, track, duration=VIDEO_DURATION_SECONDS, volume=MUSIC_VOLUME):
+        """Return the cached MusicSegment for a track, decoding it with ffmpeg on a cache miss."""
+        with self._lock:
+            if self._tracks is None:
+                self._tracks = self._build_index()
+            entry = self._tracks.get(track)
+            if entry is None:
+                raise KeyError(f"{track} is not in the music library")
+            name = f"{entry['sha1'][:16]}_{duration:g}s_{volume:g}v.pcm"
+            lock = self._segment_locks.setdefault(name, threading.Lock())
+
+        path = os.path.join(self.cache_dir, name)
+        segment = MusicSegment(path, MUSIC_SAMPLE_RATE, MUSIC_CHANNELS, duration)
+        with lock:
+            if not os.path.exists(path):
+                self._decode_segment(track, segment, volume)
+        return segment
+
+    def prepare(self, duration=VIDEO_DURATION_SECONDS, volume=MUSIC_VOLUME):
+        """Decode every track's segment up front so no MP3 is decoded while mixing."""
+        for track in self.tracks():
+            try:
+                self.segment(track, duration, volume)
+            except Exception as e:
+                print(f"Warning: could not decode music track {os.path.basename(track)}: {e}")
+
+    def _decode_segment(self, track, segment, volume):
+        ffmpeg = shutil.which(FFMPEG_BINARY)
+        if not ffmpeg:
+            raise RuntimeError(f"{FFMPEG_BINARY} not found on PATH")
+        # Write to a temporary name so concurrent processes never read a half-written segment
+        temp_path = f"{segment.path}.{uuid.uuid4().hex[:8]}.tmp"
+        command = [
+            ffmpeg, '-y', '-hide_banner', '-nostdin', '-loglevel', 'error',
+            '-i', track, '-t', f"{segment.duration:g}",
+            '-af', f"volume={volume},apad,atrim=0:{segment.duration:g}",
+            '-f', 's16le', '-ar', str(segment.sample_rate), '-ac', str(segment.channels),
+            temp_path
+        ]
+        result = subprocess.run(command, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+        if result.returncode != 0:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise RuntimeError(f"ffmpeg exited with code {result.returncode}: {result.stderr.strip()}")
+        os.replace(temp_path, segment.path)
+
+
+def _file_digest(path, algorithm="sha1"):
+    """Hex digest of a file's contents, read in 1 MiB blocks."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_json_atomic(path, data):
+    """Write JSON to a temporary file and rename it over `path` so readers never see a partial file."""
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def get_music_library():
+    """Return the process-wide MusicLibrary, creating it on first use."""
+    global _music_library
+    with _music_library_lock:
+        if _music_library is None:
+            _music_library = MusicLibrary()
+        return _music_library
+
+
 def get_random_music_track():
     """Return a random .mp3 file from the music_tracks folder."""
-    music_dir = os.path.join(os.path.dirname(__file__), "music_tracks")
-    if os.path.exists(music_dir):
-        music_files = [f for f in os.listdir(music_dir) if f.endswith('.mp3')]
-        return os.path.join(music_dir, random.choice(music_files)) if music_files else None
-    print(f"Warning: music_tracks directory not found at {music_dir}")
+    return get_music_library().random_track()
+
+
+def probe_media(media_file, ffmpeg=None):
+    """Return (duration_seconds, has_audio) for a media file, read from ffmpeg's stream listing."""
+    ffmpeg = ffmpeg or shutil.which(FFMPEG_BINARY)
+    result = subprocess.run([ffmpeg, '-hide_banner', '-nostdin', '-i', media_file],
+                            capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    duration_match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', result.stderr)
+    if not duration_match:
+        raise RuntimeError(f"Could not read duration of {media_file}: {result.stderr.strip()}")
+    hours, minutes, seconds = duration_match.groups()
+    duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    has_audio = re.search(r'Stream #\S+.*: Audio:', result.stderr) is not None
+    return duration, has_audio
+
+
+def mux_music_with_ffmpeg(video_file, music_file, output_file, volume=MUSIC_VOLUME):
+    """
+    Add background music with ffmpeg, copying the H.264 video stream untouched.
+
+    Only the audio is mixed and encoded to AAC, so no video frame is decoded.
+    The music is padded or trimmed to the clip length, which is what the
+    output keeps. music_file may be a path or a cached MusicSegment, whose
+    gain is already applied. Raises RuntimeError if ffmpeg is missing or fails.
+    """
+    ffmpeg = shutil.which(FFMPEG_BINARY)
+    if not ffmpeg:
+        raise RuntimeError(f"{FFMPEG_BINARY} not found on PATH")
+
+    duration, has_audio = probe_media(video_file, ffmpeg)
+    command = _mux_command(ffmpeg, ['-i', video_file], music_file, output_file, duration, has_audio, volume)
+    result = subprocess.run(command, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    if result.returncode != 0:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise RuntimeError(f"ffmpeg exited with code {result.returncode}: {result.stderr.strip()}")
+    return output_file
+
+
+def _mux_command(ffmpeg, video_input, music_file, output_file, duration, has_audio, volume=MUSIC_VOLUME):
+    """Build the ffmpeg stream-copy mux command for a video input given as ffmpeg arguments."""
+    if isinstance(music_file, MusicSegment):
+        # Cached PCM segment: read raw samples, gain is already applied
+        music_input = ['-f', 's16le', '-ar', str(music_file.sample_rate), '-ac', str(music_file.channels),
+                       '-i', music_file.path]
+        music_chain = f"[1:a]apad,atrim=0:{duration:.3f}"
+    else:
+        music_input = ['-i', music_file]
+        music_chain = f"[1:a]volume={volume},apad,atrim=0:{duration:.3f}"
+    if has_audio:
+        # Mix original audio with background music, same levels as the moviepy path
+        audio_filter = (f"{music_chain}[music];[0:a]volume=0.7[orig];"
+                        f"[orig][music]amix=inputs=2:duration=longest:normalize=0[aout]")
+    else:
+        audio_filter = f"{music_chain}[aout]"
+
+    return [
+        ffmpeg, '-y', '-hide_banner', '-loglevel', 'error',
+        *video_input, *music_input,
+        '-filter_complex', audio_filter,
+        '-map', '0:v:0', '-map', '[aout]',
+        '-c:v', 'copy', '-c:a', 'aac', '-b:a', '192k',
+        '-t', f"{duration:.3f}", '-movflags', '+faststart',
+        output_file
+    ]
+
+
+def _mp4_head_info(head):
+    """
+    Read (duration, has_audio) from the moov box at the start of an MP4.
+
+    Returns None while `head` is too short to tell, and False when the media
+    data comes before the moov box, in which case the file cannot be muxed
+    until it is complete.
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], 'big')
+        box = head[offset + 4:offset + 8]
+        header = 8
+        if size == 1:
+            if offset + 16 > len(head):
+                return None
+            size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+            header = 16
+        if box == b'mdat' or size < header:
+            return False
+        if box == b'moov':
+            if offset + size > len(head):
+                return None
+            moov = head[offset + header:offset + size]
+            mvhd = moov.find(b'mvhd')
+            if mvhd < 0:
+                return False
+            version = moov[mvhd + 4]
+            if version == 1:
+                timescale = int.from_bytes(moov[mvhd + 24:mvhd + 28], 'big')
+                duration = int.from_bytes(moov[mvhd + 28:mvhd + 36], 'big')
+            else:
+                timescale = int.from_bytes(moov[mvhd + 16:mvhd + 20], 'big')
+                duration = int.from_bytes(moov[mvhd + 20:mvhd + 24], 'big')
+            if not timescale:
+                return False
+            # Audio tracks declare a 'soun' handler in their hdlr box
+            return duration / timescale, b'soun' in moov
+        offset += size
     return None
 
 
-def add_music_to_video(video_file, music_file, output_file, volume=0.3):
-    """Add background music to the video at a specified volume while maintaining 9:16 aspect ratio."""
-    try:
-        # Load video and music
-        video = VideoFileClip(video_file)
+class StreamingMux:
+    """
+    Mux music into a video while it is still downloading.
+
+    Downloaded chunks are passed to feed() and piped into ffmpeg, which
+    stream-copies the video as it arrives. This only works for MP4s that start
+    with their moov box; for any other layout, or if ffmpeg fails, finish()
+    returns None and the caller muxes from the complete file as usual.
+    """
+
+    # Give up on streaming if the moov box has not been seen after this many bytes
+    MAX_HEAD_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, music_file, output_file, volume=MUSIC_VOLUME):
+        self.music_file = music_file
+        self.output_file = output_file
+        self.volume = volume
+        self._head = b''
+        self._process = None
+        self._stderr = None
+        self._failed = False
+
+    def feed(self, data):
+        if self._failed:
+            return
+        try:
+            if self._process is None:
+                self._head += data
+                info = _mp4_head_info(self._head)
+                if info is None and len(self._head) < self.MAX_HEAD_BYTES:
+                    return
+                if not info:
+                    self._failed = True
+                    self._head = b''
+                    return
+                self._start(*info)
+                data, self._head = self._head, b''
+            self._process.stdin.write(data)
+        except (OSError, RuntimeError) as e:
+            print(f"Streaming mux stopped, will mux after the download: {e}")
+            self.abort()
+
+    def _start(self, duration, has_audio):
+        ffmpeg = shutil.which(FFMPEG_BINARY)
+        if not ffmpeg:
+            raise RuntimeError(f"{FFMPEG_BINARY} not found on PATH")
+        command = _mux_command(ffmpeg, ['-f', 'mp4', '-i', 'pipe:0'], self.music_file, self.output_file,
+                               duration, has_audio, self.volume)
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                         stderr=self._stderr)
+
+    def abort(self):
+        self._failed = True
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+        if os.path.exists(self.output_file):
+            os.remove(self.output_file)
+
+    def finish(self):
+        """Wait for ffmpeg to write the output. Returns output_file, or None if streaming did not work out."""
+        if self._failed or self._process is None:
+            self.abort()
+            return None
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        returncode = self._process.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode(errors='replace').strip()
+        self._stderr.close()
+        self._process = None
+        if returncode != 0 or stderr:
+            # A truncated or malformed input can still exit 0, so any error output counts as failure
+            print(f"Streaming mux failed, will mux after the download: {stderr or f'exit code {returncode}'}")
+            self.abort()
+            return None
+        return self.output_file
+
+
+def mux_music_with_moviepy(video_file, music_file, output_file, volume=MUSIC_VOLUME):
+    """Add background music by decoding and re-encoding the whole clip with moviepy."""
+    from moviepy.audio.AudioClip import AudioArrayClip
+    from moviepy.editor import AudioFileClip, CompositeAudioClip, VideoFileClip
+
+    # Load video and music
+    video = VideoFileClip(video_file)
+    if isinstance(music_file, MusicSegment):
+        # Cached PCM segment: gain is already applied
+        music = AudioArrayClip(music_file.load_array() / 32768.0, fps=music_file.sample_rate)
+        music = music.subclip(0, min(music.duration, video.duration))
+    else:
         music = AudioFileClip(music_file)
 
         # Trim music to match video duration (8 seconds)
         music = music.subclip(0, min(music.duration, video.duration)).volumex(volume)
 
-        # Get original video audio (if any) and mix with music
-        if video.audio is not None:
-            # Mix original audio with background music
-            final_audio = CompositeAudioClip([video.audio.volumex(0.7), music])
-        else:
-            # Use only background music
-            final_audio = music
-
-        # Set the final audio to video
-        final_video = video.set_audio(final_audio)
-
-        # Write the final video with same aspect ratio (9:16 is preserved automatically)
-        final_video.write_videofile(
-            output_file,
-            codec="libx264",
-            audio_codec="aac",
-            temp_audiofile='temp-audio.m4a',
-            remove_temp=True,
-            verbose=False,
-            logger=None  # Reduce verbose output
-        )
+    # Get original video audio (if any) and mix with music
+    if video.audio is not None:
+        # Mix original audio with background music
+        final_audio = CompositeAudioClip([video.audio.volumex(0.7), music])
+    else:
+        # Use only background music
+        final_audio = music
+
+    # Set the final audio to video
+    final_video = video.set_audio(final_audio)
+
+    # Write the final video with same aspect ratio (9:16 is preserved automatically)
+    final_video.write_videofile(
+        output_file,
+        codec="libx264",
+        audio_codec="aac",
+        temp_audiofile=f"{output_file}.temp-audio.m4a",  # Unique per output so parallel encodes do not collide
+        remove_temp=True,
+        verbose=False,
+        logger=None  # Reduce verbose output
+    )
+
+    # Clean up
+    video.close()
+    music.close()
+    final_video.close()
+    return output_file
+
 
-        # Clean up
-        video.close()
-        music.close()
-        final_video.close()
+def add_music_to_video(video_file, music_file, output_file, volume=MUSIC_VOLUME):
+    """
+    Add background music to the video at a specified volume while maintaining 9:16 aspect ratio.
+
+    The video stream is copied as-is with ffmpeg; inputs ffmpeg cannot copy fall
+    back to a full moviepy re-encode. music_file is either an audio file path or
+    a MusicSegment from the music library.
+    """
+    try:
+        mux_music_with_ffmpeg(video_file, music_file, output_file, volume)
+        print("✓ Music added successfully (video stream copied). Video aspect ratio maintained: 9:16")
+        return output_file
+    except Exception as e:
+        print(f"Stream-copy mux failed, re-encoding with moviepy instead: {e}")
 
+    try:
+        mux_music_with_moviepy(video_file, music_file, output_file, volume)
         print(f"✓ Music added successfully. Video aspect ratio maintained: 9:16")
         return output_file
 
@@ -328,17 +1681,319 @@ def add_music_to_video(video_file, music_file, output_file, volume=0.3):
         return video_file  # Return original video file if music addition fails
 
 
-def main():
-    """Main function to orchestrate the video generation and upload process."""
-    # Create output folder for generated videos
-    output_folder = create_output_folder()
+class Variant(namedtuple('Variant', ['name', 'music_file', 'volume', 'duration'], defaults=(None, MUSIC_VOLUME, None))):
+    """
+    One output of render_variants.
+
+    music_file None means the clip's own audio only; duration None keeps the
+    clip length, a shorter one trims it and a longer one loops the clip.
+    """
+
+
+def parse_variant(spec):
+    """
+    Parse a --variant spec such as "quiet:volume=0.15" or "long:music=track.mp3,duration=16".
+
+    Raises argparse.ArgumentTypeError for malformed specs, so it can be used as an argparse type.
+    """
+    name, _, settings = spec.partition(':')
+    if not re.fullmatch(r'[\w-]+', name):
+        raise argparse.ArgumentTypeError(f"variant name must be letters, digits, '_' or '-': {spec!r}")
+    values = {}
+    for setting in filter(None, settings.split(',')):
+        key, _, value = setting.partition('=')
+        try:
+            if key == 'music':
+                if not value:
+                    raise ValueError
+                # Recorded in the job, so it must not depend on the directory it was typed in
+                values['music_file'] = os.path.abspath(value)
+            elif key in ('volume', 'duration'):
+                values[key] = float(value)
+                if values[key] < 0 or (key == 'duration' and not values[key]):
+                    raise ValueError
+            else:
+                raise argparse.ArgumentTypeError(f"unknown variant setting {key!r} in {spec!r}")
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid {key} in variant {spec!r}")
+    return Variant(name, **values)
+
+
+def render_variants(video_file, variants, output_files):
+    """
+    Render several music and length variants of a clip with one ffmpeg run.
+
+    The clip is demuxed once and its video stream is copied into every output;
+    each music track is decoded once and split between the variants that use
+    it, so only the per-variant audio mix is encoded. If a variant is longer
+    than the clip, the clip is looped and each output is cut at its own
+    duration. output_files maps variant names to paths. Returns output_files,
+    or raises RuntimeError if ffmpeg is missing or fails.
+    """
+    ffmpeg = shutil.which(FFMPEG_BINARY)
+    if not ffmpeg:
+        raise RuntimeError(f"{FFMPEG_BINARY} not found on PATH")
+
+    clip_duration, has_audio = probe_media(video_file, ffmpeg)
+    durations = [variant.duration or clip_duration for variant in variants]
+    loop = ['-stream_loop', '-1'] if max(durations) > clip_duration else []
+    inputs = [*loop, '-i', video_file]
+    tracks = []
+    for variant in variants:
+        if variant.music_file and variant.music_file not in tracks:
+            tracks.append(variant.music_file)
+            inputs += ['-i', variant.music_file]
+
+    # Split every shared audio source so each variant gets its own copy
+    filters = []
+    split_labels = {}
+    sources = [('0:a', len(variants))] if has_audio else []
+    for index, track in enumerate(tracks, 1):
+        sources.append((f'{index}:a', sum(1 for variant in variants if variant.music_file == track)))
+    for source, users in sources:
+        labels = [f"{source.replace(':', '_')}_{n}" for n in range(users)]
+        filters.append(f"[{source}]asplit={users}" + ''.join(f"[{label}]" for label in labels))
+        split_labels[source] = iter(labels)
+
+    outputs = []
+    for number, (variant, duration) in enumerate(zip(variants, durations)):
+        mix = []
+        if has_audio:
+            filters.append(f"[{next(split_labels['0:a'])}]volume=0.7[orig{number}]")
+            mix.append(f"[orig{number}]")
+        if variant.music_file:
+            source = f"{tracks.index(variant.music_file) + 1}:a"
+            filters.append(f"[{next(split_labels[source])}]volume={variant.volume},apad,"
+                           f"atrim=0:{duration:.3f}[music{number}]")
+            mix.append(f"[music{number}]")
+        if len(mix) == 2:
+            filters.append(f"{''.join(mix)}amix=inputs=2:duration=longest:normalize=0[aout{number}]")
+            audio_map = ['-map', f"[aout{number}]"]
+        elif mix:
+            audio_map = ['-map', mix[0]]
+        else:
+            audio_map = []
+        outputs += ['-map', '0:v:0', *audio_map, '-c:v', 'copy', *(['-c:a', 'aac', '-b:a', '192k'] if mix else []),
+                    '-t', f"{duration:.3f}", '-movflags', '+faststart', output_files[variant.name]]
+
+    command = [ffmpeg, '-y', '-hide_banner', '-nostdin', '-loglevel', 'error', *inputs,
+               *(['-filter_complex', ';'.join(filters)] if filters else []), *outputs]
+    result = subprocess.run(command, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    if result.returncode != 0:
+        for output_file in output_files.values():
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        raise RuntimeError(f"ffmpeg exited with code {result.returncode}: {result.stderr.strip()}")
+    return output_files
+
+
+CachedResponse = namedtuple('CachedResponse', ['text'])
+
+
+class GenaiResponseCache:
+    """
+    On-disk cache of Gemini text responses, keyed by a hash of model, contents and config.
+
+    Modes:
+      cache  - serve an unexpired cached response, otherwise call the API and store it
+      record - always call the API and store the response for later replay
+      replay - serve only recorded responses; a miss raises instead of going online
+    Entries expire after `ttl` seconds (except in replay mode) and the least
+    recently used ones are evicted beyond `max_entries`.
+    """
+
+    MODES = ("off", "cache", "record", "replay")
+
+    def __init__(self, folder=GENAI_CACHE_FOLDER, mode="cache", ttl=GENAI_CACHE_TTL, max_entries=GENAI_CACHE_MAX_ENTRIES):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, expected one of {self.MODES}")
+        self.folder = folder
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(model, contents, config=None):
+        """Content address of a request: SHA-256 over its canonical JSON form."""
+        if config is not None and hasattr(config, 'model_dump'):
+            config = config.model_dump(mode='json', exclude_none=True)
+        request = {"model": model, "contents": contents, "config": config}
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key):
+        """Return the cached response text for a key, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.mode != "replay" and time.time() - entry["created_at"] > self.ttl:
+            return None
+        os.utime(path)  # Mark as recently used for eviction
+        return entry["text"]
+
+    def put(self, key, text, model):
+        _write_json_atomic(self._path(key), {"model": model, "text": text, "created_at": time.time()})
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = [entry for entry in os.scandir(self.folder) if entry.name.endswith('.json')]
+            if len(entries) <= self.max_entries:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_entries]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class CachingModels:
+    """Stand-in for client.models whose generate_content goes through a GenaiResponseCache."""
+
+    def __init__(self, models, cache):
+        self._models = models
+        self.cache = cache
+
+    def generate_content(self, *, model, contents, config=None):
+        key = self.cache.key(model, contents, config)
+        if self.cache.mode in ("cache", "replay"):
+            text = self.cache.get(key)
+            metrics.increment("genai_cache_requests_total", result="miss" if text is None else "hit")
+            if text is not None:
+                return CachedResponse(text)
+            if self.cache.mode == "replay":
+                raise LookupError(f"No recorded {model} response for request {key[:12]} (replay mode)")
+
+        response = self._models.generate_content(model=model, contents=contents, config=config)
+        if response.text is not None:
+            self.cache.put(key, response.text, model)
+        return response
 
-    client = genai.Client(api_key=os.getenv("GENAI_API_KEY", "123"))
+    def __getattr__(self, name):
+        # Everything else (generate_videos, ...) goes straight to the real client
+        return getattr(self._models, name)
 
-    used_prompts = load_used_prompts()
+
+class CachingClient:
+    """Wrap a genai.Client so that text generation is served from a GenaiResponseCache."""
+
+    def __init__(self, client, cache):
+        self._client = client
+        self.models = CachingModels(client.models, cache)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+class RateLimitedModels:
+    """Stand-in for client.models that paces Gemini and Veo requests and retries 429 responses."""
+
+    def __init__(self, models):
+        self._models = models
+
+    def generate_content(self, **kwargs):
+        return self._call("gemini", self._models.generate_content, kwargs)
+
+    def generate_videos(self, **kwargs):
+        return self._call("veo", self._models.generate_videos, kwargs)
+
+    def _call(self, api, method, kwargs):
+        from google.genai import errors as genai_errors
+
+        for attempt in range(1, RATE_LIMIT_MAX_RETRIES + 1):
+            wait_for_rate_limit(api)
+            try:
+                return method(**kwargs)
+            except genai_errors.APIError as e:
+                if e.code != 429 or attempt == RATE_LIMIT_MAX_RETRIES:
+                    raise
+                delay = random.uniform(0.5, 1.0) * min(2 ** attempt, 60)
+                print(f"{api} rate limit hit (429), retry {attempt}/{RATE_LIMIT_MAX_RETRIES} in {delay:.1f}s")
+                metrics.increment("retries_total", operation=api)
+                time.sleep(delay)
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+
+class RateLimitedClient:
+    """Wrap a genai.Client so its model calls go through the per-API token buckets."""
+
+    def __init__(self, client):
+        self._client = client
+        self.models = RateLimitedModels(client.models)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def create_genai_client(cache_mode=GENAI_CACHE_MODE):
+    """
+    Create the rate-limited genai client, wrapped in the response cache unless cache_mode is "off".
+
+    The cache sits outside the rate limiter, so cached responses never wait for a token.
+    """
+    from google import genai
+
+    client = RateLimitedClient(genai.Client(api_key=os.getenv("GENAI_API_KEY", "123")))
+    if cache_mode != "off":
+        print(f"Gemini response cache enabled ({cache_mode} mode, {GENAI_CACHE_FOLDER})")
+        client = CachingClient(client, GenaiResponseCache(mode=cache_mode))
+    return client
+
+
+def reserve_used_prompt(food_item):
+    """Record a food item as used, returning False if another job already claimed it."""
+    return get_used_item_store().add(food_item)
+
+
+def parse_idea_candidates(video_text):
+    """Split an idea response into (food_item, video_prompt) pairs, one per "Food Item:" block."""
+    candidates = []
+    for block in re.split(r'Food Item:', video_text, flags=re.IGNORECASE)[1:]:
+        item_match = re.match(r'\s*(.+?)\s*(?=\[0\.0s|\n|$)', block)
+        if not item_match:
+            continue
+        food_item = item_match.group(1).strip().strip('*').strip()
+        video_prompt = re.sub(r'(\s*(-{3,}|\*+))+\s*$', '', block[item_match.end():]).strip()
+        if food_item and video_prompt:
+            candidates.append((food_item, video_prompt))
+    return candidates
+
+
+def channel_prompt_notes(niche=None, mascot=None):
+    """Extra prompt lines for a job's niche and mascot overrides, or "" when there are none."""
+    notes = []
+    if niche:
+        notes.append(f"Channel niche: {niche}. Every item and video must fit this niche.")
+    if mascot:
+        notes.append(f"Mascot: {mascot}. Use this mascot instead of Zesty.")
+    return "\n    ".join(notes)
+
+
+def generate_video_idea(client, used_prompts, niche=None, mascot=None):
+    """
+    Ask Gemini for a new food item and its 8-second video prompt.
+
+    One call returns IDEA_CANDIDATES candidates, which are checked locally against
+    the full used item store, so a repeated item only costs a fallback to the next
+    candidate. `used_prompts` is only a hint for the model and should be kept short
+    (e.g. the most recent items); the prompt size stays flat as the channel grows.
+    niche and mascot override the channel defaults for this video.
+    """
+    from google.genai import types
 
     video_prompt_text = """
-    Suggest a unique food or drink item that has not been used before, and generate a vibrant, high-engagement 8-second short-form video idea for making that item, designed for Instagram Reels, TikTok, or YouTube Shorts. The video should follow this format:
+    Suggest {candidates} different unique food or drink items that have not been used before, and for each one generate a vibrant, high-engagement 8-second short-form video idea for making that item, designed for Instagram Reels, TikTok, or YouTube Shorts. Each video should follow this format:
 
     The video features a recurring mascot character (e.g., a quirky yellow cat chef named "Zesty"), who helps prepare the item in a fun, fast-paced, and visually playful way.
 
@@ -350,7 +2005,7 @@ def main():
 
     End with a hero shot of the finished dish or drink being presented by the character with a cheeky action (like a wink, tail flick, or dance), plus overlay text and a catchy sound.
 
-    Make sure the video is full of energy, charm, and irresistible food visuals, all within an 8-second runtime. Output the food item first, followed by the video prompt in this structure:
+    Make sure each video is full of energy, charm, and irresistible food visuals, all within an 8-second runtime. For each candidate, output the food item first, followed by the video prompt in this structure, and separate candidates with a line containing only ---:
 
     Food Item: <unique food or drink item>
     [0.0s–2s] → [Scene Description + Angle/Sound/Action]
@@ -358,43 +2013,47 @@ def main():
     [4s–6s] → [Scene Description + Angle/Sound/Action]
     [6s–8s] → [Final Scene + Overlay Text + Mascot Gag + Sound Effect]
 
-    Ensure the suggested food item is not in this list of previously used items: {used_prompts}
+    Ensure the suggested food items are not in this list of previously used items: {used_prompts}
     """
 
-    try:
+    notes = channel_prompt_notes(niche, mascot)
+    excluded = list(used_prompts)
+    for attempt in range(1, IDEA_MAX_ATTEMPTS + 1):
+        prompt = video_prompt_text.format(candidates=IDEA_CANDIDATES, used_prompts=excluded)
+        if notes:
+            prompt += f"\n    {notes}\n"
         video_response = client.models.generate_content(
             model="gemini-2.0-flash",
-            contents=[video_prompt_text.format(used_prompts=used_prompts)],
-            config=types.GenerateContentConfig(max_output_tokens=500, temperature=0.7)
+            contents=[prompt],
+            config=types.GenerateContentConfig(max_output_tokens=500 * IDEA_CANDIDATES, temperature=0.7)
         )
         video_text = video_response.text.strip()
         print("Generated response:", video_text)
 
-        food_item_match = re.search(r'Food Item:\s*(.+?)(?=\[0\.0s|$)', video_text, re.IGNORECASE | re.DOTALL)
-        if not food_item_match:
+        candidates = parse_idea_candidates(video_text)
+        if not candidates:
             raise ValueError("Failed to extract food item from AI response.")
-        food_item = food_item_match.group(1).strip()
-        if food_item in used_prompts:
-            raise ValueError(f"Generated food item '{food_item}' is already used. Please try again with a new item.")
-        video_prompt = video_text[food_item_match.end():].strip()
-        print(f"Selected food item: {food_item}")
-        print("Generated video prompt:", video_prompt)
 
-    except Exception as e:
-        print(f"Process failed during food item and video prompt generation: {e}")
-        return
+        for food_item, video_prompt in candidates:
+            if reserve_used_prompt(food_item):
+                print(f"Selected food item: {food_item}")
+                print("Generated video prompt:", video_prompt)
+                return food_item, video_prompt
+            print(f"Skipping already used food item: {food_item}")
+            metrics.increment("used_item_collisions_total")
+            excluded.append(food_item)
 
-    save_used_prompt(food_item)
+        print(f"All {len(candidates)} candidates were already used (attempt {attempt}/{IDEA_MAX_ATTEMPTS})")
 
-    music_file = get_random_music_track()
-    if music_file:
-        print(f"Selected music track: {os.path.basename(music_file)}")
-    else:
-        print("No music track selected, using default behavior.")
-        music_file = "sugar_rush.mp3"
+    raise ValueError("Every generated food item is already used. Please try again with a new item.")
+
+
+def generate_metadata(client, food_item, video_prompt, niche=None, mascot=None):
+    """Ask Gemini for SEO metadata for the video and parse it into title, description and keywords."""
+    from google.genai import types
 
     metadata_prompt = f"""
-    Based on the following video prompt, generate comprehensive SEO-optimized YouTube video metadata for an 8-second video about making {food_item} with a quirky mascot character named Zesty. 
+    Based on the following video prompt, generate comprehensive SEO-optimized YouTube video metadata for an 8-second video about making {food_item} with a quirky mascot character named Zesty.
 
     CRITICAL REQUIREMENTS:
     - Include AT LEAST 15 hashtags in the description
@@ -404,7 +2063,7 @@ def main():
     - NO APOSTROPHES in title or description (use alternative phrasing)
     - Use proper JSON escape sequences for any special characters
 
-    Provide the metadata EXCLUSIVELY as a valid JSON object within ```json ... ```. Do NOT include any text outside the ```json ... ``` block. Use this exact structure with DOUBLE QUOTES only and NO APOSTROPHES:
+    Provide the metadata EXCLUSIVELY as a valid JSON object. Do NOT include any text outside the JSON object. Use this exact structure with DOUBLE QUOTES only and NO APOSTROPHES:
 
     ```json
     {{
@@ -426,96 +2085,1258 @@ def main():
 
     Video prompt: {video_prompt}
     """.strip()
+    notes = channel_prompt_notes(niche, mascot)
+    if notes:
+        metadata_prompt += f"\n\n    {notes}"
+
+    metadata_response = client.models.generate_content(
+        model="gemini-2.0-flash",
+        contents=[metadata_prompt],
+        config=types.GenerateContentConfig(
+            max_output_tokens=800,
+            temperature=0.7,
+            response_mime_type="application/json",  # Schema-constrained JSON, no code fence
+            response_schema=METADATA_RESPONSE_SCHEMA
+        )
+    )
+    metadata_text = metadata_response.text.strip()
+    title, description, keywords = parse_metadata(metadata_text)
+    print("Generated metadata:", {'title': title, 'description': description, 'keywords_count': len(keywords)})
+    return title, description, keywords
 
-    try:
-        metadata_response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=[metadata_prompt],
-            config=types.GenerateContentConfig(max_output_tokens=800, temperature=0.7)
+
+class _PendingOperation:
+    """Book-keeping for one Veo operation tracked by VeoPoller."""
+
+    def __init__(self, operation, future, submitted_at, next_poll_at):
+        self.operation = operation
+        self.future = future
+        self.submitted_at = submitted_at
+        self.next_poll_at = next_poll_at
+        self.errors = 0
+
+
+class VeoPoller:
+    """
+    Track many pending Veo operations from one background thread.
+
+    Every submitted operation gets a Future that resolves with the finished
+    operation. Poll times adapt to how long recent renders took: an operation
+    is first checked when a typical render would be finished (the median of
+    recent render times), then polled at short intervals that back off as it
+    runs past that estimate, up to max_interval apart.
+    """
+
+    def __init__(self, client, min_interval=VEO_POLL_MIN_INTERVAL, max_interval=VEO_POLL_MAX_INTERVAL):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._durations = deque(maxlen=50)  # Observed render times in seconds
+        self._pending = {}
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    def expected_duration(self):
+        """Median of recently observed render times, or the default estimate."""
+        if not self._durations:
+            return VEO_POLL_DEFAULT_ESTIMATE
+        return statistics.median(self._durations)
+
+    def _next_delay(self, elapsed):
+        """Seconds to wait before polling an operation that has been running for `elapsed` seconds."""
+        remaining = self.expected_duration() - elapsed
+        if remaining > self.min_interval:
+            # Nothing to learn before a typical render would be done
+            return remaining
+        # Past the estimate: poll often at first, then back off for outliers
+        overdue = -remaining
+        return min(self.min_interval + overdue * 0.25, self.max_interval)
+
+    def submit(self, operation, callback=None):
+        """Start tracking an operation and return a Future for the finished operation."""
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        if operation.done:
+            self._resolve(future, operation)
+            return future
+
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("VeoPoller is closed")
+            entry = _PendingOperation(operation, future, now, now + self._next_delay(0))
+            self._pending[next(self._ids)] = entry
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="veo-poller", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def pending_count(self):
+        """Number of operations still being polled."""
+        with self._cond:
+            return len(self._pending)
+
+    def cancel_pending(self, exception):
+        """Stop polling every pending operation and fail its Future with `exception`."""
+        with self._cond:
+            entries = list(self._pending.values())
+            self._pending.clear()
+            self._cond.notify()
+        for entry in entries:
+            if not entry.future.done():
+                entry.future.set_exception(exception)
+        return len(entries)
+
+    def close(self):
+        """Stop accepting operations and wait for the pending ones to finish."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _resolve(self, future, operation):
+        if operation.error:
+            future.set_exception(RuntimeError(f"Video generation failed: {operation.error}"))
+        else:
+            future.set_result(operation)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        if self._closed:
+                            self._thread = None
+                            return
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    next_poll_at = min(entry.next_poll_at for entry in self._pending.values())
+                    if next_poll_at <= now:
+                        break
+                    self._cond.wait(timeout=next_poll_at - now)
+                due = [(key, entry) for key, entry in self._pending.items() if entry.next_poll_at <= now]
+
+            # Poll outside the lock so new submissions are never blocked on the network
+            for key, entry in due:
+                self._poll(key, entry)
+
+    def _poll(self, key, entry):
+        try:
+            operation = self.client.operations.get(entry.operation)
+        except Exception as e:
+            entry.errors += 1
+            if entry.errors >= VEO_POLL_MAX_ERRORS:
+                if self._take(key):
+                    entry.future.set_exception(e)
+                return
+            print(f"Polling video generation failed ({entry.errors}/{VEO_POLL_MAX_ERRORS}), retrying: {e}")
+            metrics.increment("retries_total", operation="veo_poll")
+            entry.next_poll_at = time.monotonic() + self.max_interval
+            return
+
+        entry.errors = 0
+        now = time.monotonic()
+        elapsed = now - entry.submitted_at
+        if not operation.done:
+            entry.operation = operation
+            entry.next_poll_at = now + self._next_delay(elapsed)
+            return
+
+        if not self._take(key, elapsed):
+            return
+        print(f"✓ Video render finished after {elapsed:.0f}s ({self.pending_count()} still pending)")
+        self._resolve(entry.future, operation)
+
+    def _take(self, key, elapsed=None):
+        """
+        Stop tracking an operation that is about to be resolved, recording its render time if given.
+
+        Returns False if cancel_pending() already removed it (and failed its
+        Future) while it was being polled, in which case it must be left alone.
+        """
+        with self._cond:
+            entry = self._pending.pop(key, None)
+            if entry is None or entry.future.done():
+                return False
+            if elapsed is not None:
+                self._durations.append(elapsed)
+            return True
+
+
+def start_video_generation(client, video_prompt):
+    """Submit the video prompt to Veo and return the long-running operation."""
+    from google.genai import types
+
+    print("Starting video generation...")
+    return client.models.generate_videos(
+        model="veo-2.0-generate-001",
+        prompt=video_prompt,
+        config=types.GenerateVideosConfig(
+            person_generation="allow_all",
+            aspect_ratio="9:16",  # Maintain 9:16 aspect ratio
+            number_of_videos=1,
+            duration_seconds=VIDEO_DURATION_SECONDS,
+            enhance_prompt=True
         )
-        metadata_text = metadata_response.text.strip()
-        title, description, keywords = parse_metadata(metadata_text)
-        print("Generated metadata:", {'title': title, 'description': description, 'keywords_count': len(keywords)})
+    )
 
-    except Exception as e:
-        print(f"Process failed during metadata generation: {e}")
-        return
 
-    # Generate unique filenames and save in output folder
-    sanitized_food_item = sanitize_filename(food_item)
-    video_filename = f"{sanitized_food_item}_{uuid.uuid4().hex[:8]}.mp4"
-    video_file = os.path.join(output_folder, video_filename)
+def wait_for_video(client, operation, poller=None):
+    """Wait for a Veo operation to finish and return the finished operation.
 
+    Completion is awaited through `poller` so many renders can share one polling thread.
+    """
+    # Hand the operation to the shared poller; a one-off poller serves single calls
+    own_poller = poller is None
+    if own_poller:
+        poller = VeoPoller(client)
     try:
-        print("Starting video generation...")
-        operation = client.models.generate_videos(
-            model="veo-2.0-generate-001",
-            prompt=video_prompt,
-            config=types.GenerateVideosConfig(
-                person_generation="allow_all",
-                aspect_ratio="9:16",  # Maintain 9:16 aspect ratio
-                number_of_videos=1,
-                duration_seconds=8,
-                enhance_prompt=True
-            )
-        )
+        print(f"Waiting for video generation... (expected ~{poller.expected_duration():.0f}s)")
+        return poller.submit(operation).result()
+    finally:
+        if own_poller:
+            poller.close()
 
-        while not operation.done:
-            print("Waiting for video generation... (checking every 20 seconds)")
-            time.sleep(20)
-            operation = client.operations.get(operation)
 
-        for n, generated_video in enumerate(operation.response.generated_videos):
-            print(f"Saving video as {video_file}")
-            client.files.download(file=generated_video.video)
-            generated_video.video.save(video_file)
-            print(f"✓ Video generation complete. Saved to: {video_file}")
+class _DownloadSink:
+    """Writable target for files.download that writes chunks to disk, hashes them and forwards them."""
 
-    except Exception as e:
-        print(f"Process failed during video generation or saving: {e}")
-        return
+    def __init__(self, file, consumer=None):
+        self._file = file
+        self.consumer = consumer
+        self.sha256 = hashlib.sha256()
+        self.size = 0
 
-    try:
-        # Create filename for video with music in the same output folder
-        music_video_filename = f"{sanitized_food_item}_with_music_{uuid.uuid4().hex[:8]}.mp4"
-        video_with_music = os.path.join(output_folder, music_video_filename)
+    def write(self, data):
+        self._file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        if self.consumer is not None:
+            self.consumer.feed(data)
+        return len(data)
 
-        # Add music while maintaining 9:16 aspect ratio
-        final_video = add_music_to_video(video_file, music_file, video_with_music)
-        print(f"✓ Final video with music saved to: {final_video}")
 
-    except Exception as e:
-        print(f"Process failed during music addition: {e}")
-        final_video = video_file  # Use original video if music addition fails
+def save_generated_video(client, operation, video_file, consumer=None):
+    """
+    Download the clip of a finished Veo operation to video_file and return its SHA-256.
 
+    The clip is streamed to disk in chunks (1 MiB with the current SDK), so
+    memory stays flat however many renders finish at once. Each chunk is hashed
+    as it arrives and also passed to consumer.feed(), e.g. a StreamingMux. The
+    file only appears under its final name once it is complete.
+    """
+    generated_video = operation.response.generated_videos[0]
+    print(f"Saving video as {video_file}")
+    temp_path = f"{video_file}.{uuid.uuid4().hex[:8]}.part"
     try:
-        youtube = authenticate_youtube()
+        try:
+            with open(temp_path, 'wb') as f:
+                sink = _DownloadSink(f, consumer)
+                client.files.download(file=generated_video.video, destination=sink)
+            digest = sink.sha256.hexdigest()
+        except TypeError:
+            # SDK without streaming downloads: fetch into memory and write it out
+            print("This google-genai version cannot stream downloads, downloading in one piece")
+            client.files.download(file=generated_video.video)
+            generated_video.video.save(temp_path)
+            digest = _file_digest(temp_path, "sha256")
+        os.replace(temp_path, video_file)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    print(f"✓ Video generation complete. Saved {os.path.getsize(video_file) / 1e6:.1f} MB to: {video_file}")
+    return digest
 
-    except Exception as e:
-        print(f"Process failed during YouTube authentication: {e}")
-        return
 
-    try:
+class JobRecord:
+    """
+    Checkpoint of one video job, saved to JOBS_FOLDER/<job_id>.json.
+
+    Every stage stores its output here as soon as it finishes (idea, music
+    track, metadata, Veo operation, raw and music video paths, upload id), so a
+    failed or interrupted job resumes at its first incomplete stage instead of
+    paying for a new idea and render.
+    """
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, **fields):
+        """Start a new job record and save it."""
+        os.makedirs(JOBS_FOLDER, exist_ok=True)
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        job = cls(os.path.join(JOBS_FOLDER, f"{job_id}.json"),
+                  {"job_id": job_id, "status": "pending", "created_at": time.time(), **fields})
+        job.update()
+        return job
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(path, json.load(f))
+
+    @classmethod
+    def saved(cls):
+        """All saved jobs, oldest first."""
+        if not os.path.exists(JOBS_FOLDER):
+            return []
+        jobs = []
+        for name in os.listdir(JOBS_FOLDER):
+            if not name.endswith('.json'):
+                continue
+            try:
+                jobs.append(cls.load(os.path.join(JOBS_FOLDER, name)))
+            except (OSError, ValueError) as e:
+                print(f"Warning: skipping unreadable job record {name}: {e}")
+        return sorted(jobs, key=lambda job: job.get("created_at", 0))
+
+    @classmethod
+    def unfinished(cls):
+        """
+        All saved jobs that have not been uploaded yet, oldest first.
+
+        Jobs still held by the worker queue, and jobs another process
+        checkpointed as running within JOB_RUNNING_STALE_SECONDS, are left out
+        so that two processes never continue the same job.
+        """
+        active = set()
+        if os.path.exists(JOB_QUEUE_DB):
+            queue = JobQueue()
+            try:
+                active = queue.active_job_ids()
+            finally:
+                queue.close()
+        now = time.time()
+        return [
+            job for job in cls.saved()
+            if job.get("status") != "uploaded" and job.job_id not in active
+            and not (job.get("status") == "running" and now - job.get("updated_at", 0) < JOB_RUNNING_STALE_SECONDS)
+        ]
+
+    @classmethod
+    def latest(cls):
+        """The most recently created job, finished or not, or None."""
+        jobs = cls.saved()
+        return jobs[-1] if jobs else None
+
+    @classmethod
+    def find(cls, job_id=None):
+        """Load a saved job by id, or the most recent unfinished job. Returns None if there is none."""
+        if job_id is None:
+            jobs = cls.unfinished()
+            return jobs[-1] if jobs else None
+        path = os.path.join(JOBS_FOLDER, f"{job_id}.json")
+        return cls.load(path) if os.path.exists(path) else None
+
+    @property
+    def job_id(self):
+        return self.data["job_id"]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def update(self, **fields):
+        """Merge stage outputs into the record and write it to disk atomically."""
+        with self._lock:
+            self.data.update(fields)
+            self.data["updated_at"] = time.time()
+            _write_json_atomic(self.path, self.data)
+
+
+QueuedRequest = namedtuple('QueuedRequest', ['id', 'options', 'job_id', 'attempts'])
+
+
+class JobQueue:
+    """
+    Durable queue of video requests in SQLite, shared by enqueue and worker processes.
+
+    Claiming a request is one IMMEDIATE transaction, so two workers never take
+    the same one. Each request remembers the JobRecord it started: a retried
+    or interrupted request continues that job from its last checkpoint. A
+    request is not handed out before its not_before time, which delays retries
+    and uploads waiting for the YouTube quota. A claimed request is leased to
+    this queue's owner (host and pid) until renew() stops being called; only
+    requests whose lease expired are taken back from a worker.
+    """
+
+    def __init__(self, path=JOB_QUEUE_DB, lease_seconds=WORKER_LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, options TEXT NOT NULL, status TEXT NOT NULL, "
+                "job_id TEXT, attempts INTEGER NOT NULL DEFAULT 0, not_before REAL NOT NULL DEFAULT 0, "
+                "error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS requests_due ON requests (status, not_before)")
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(requests)")}
+            # Queues created before leases existed gain the columns; their running rows count as expired
+            if "owner" not in columns:
+                self._conn.execute("ALTER TABLE requests ADD COLUMN owner TEXT")
+            if "lease_expires" not in columns:
+                self._conn.execute("ALTER TABLE requests ADD COLUMN lease_expires REAL NOT NULL DEFAULT 0")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, options, max_queued=WORKER_MAX_QUEUED):
+        """Add a request with job overrides. Returns its id, or None when max_queued requests are already waiting."""
+        now = time.time()
+        with self._transaction() as conn:
+            queued = conn.execute("SELECT COUNT(*) FROM requests WHERE status = 'queued'").fetchone()[0]
+            if queued >= max_queued:
+                return None
+            cursor = conn.execute(
+                "INSERT INTO requests (options, status, created_at, updated_at) VALUES (?, 'queued', ?, ?)",
+                (json.dumps(options), now, now))
+            return cursor.lastrowid
+
+    def claim(self):
+        """Lease the oldest due request to this owner and return it as a QueuedRequest, or None."""
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_expired(conn, now)
+            row = conn.execute(
+                "SELECT id, options, job_id, attempts FROM requests WHERE status = 'queued' AND not_before <= ? "
+                "ORDER BY not_before, id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE requests SET status = 'running', attempts = attempts + 1, owner = ?, "
+                         "lease_expires = ?, updated_at = ? WHERE id = ?",
+                         (self.owner, now + self.lease_seconds, now, row[0]))
+        return QueuedRequest(row[0], json.loads(row[1]), row[2], row[3] + 1)
+
+    def set_job(self, request_id, job_id):
+        with self._transaction() as conn:
+            conn.execute("UPDATE requests SET job_id = ?, updated_at = ? WHERE id = ?", (job_id, time.time(), request_id))
+
+    def finish(self, request_id, status="done", error=None):
+        with self._transaction() as conn:
+            conn.execute("UPDATE requests SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                         (status, error, time.time(), request_id))
+
+    def retry(self, request_id, delay=0, error=None, count_attempt=True):
+        """Put a claimed request back in the queue, due after `delay` seconds."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE requests SET status = 'queued', not_before = ?, error = ?, updated_at = ?, "
+                         "attempts = attempts - ? WHERE id = ?",
+                         (now + delay, error, now, 0 if count_attempt else 1, request_id))
+
+    def renew(self):
+        """Extend the lease on every request this owner is running."""
+        with self._transaction() as conn:
+            conn.execute("UPDATE requests SET lease_expires = ? WHERE status = 'running' AND owner = ?",
+                         (time.time() + self.lease_seconds, self.owner))
+
+    @staticmethod
+    def _requeue_expired(conn, now):
+        cursor = conn.execute("UPDATE requests SET status = 'queued', attempts = attempts - 1, owner = NULL, "
+                              "updated_at = ? WHERE status = 'running' AND lease_expires < ?", (now, now))
+        return cursor.rowcount
+
+    def recover(self):
+        """Requeue requests whose worker died and stopped renewing their lease. Returns how many there were."""
+        with self._transaction() as conn:
+            return self._requeue_expired(conn, time.time())
+
+    def active_job_ids(self):
+        """Ids of the jobs that queued or running requests will continue."""
+        with self._lock:
+            rows = self._conn.execute("SELECT job_id FROM requests WHERE status IN ('queued', 'running') "
+                                      "AND job_id IS NOT NULL").fetchall()
+        return {row[0] for row in rows}
+
+    def counts(self):
+        """Number of requests per status."""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM requests GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _have_file(path):
+    return bool(path) and os.path.exists(path)
+
+
+class JobInterrupted(Exception):
+    """A stage stopped for a reason that says nothing about the job; it continues from its checkpoint."""
+
+
+class ShutdownRequested(JobInterrupted):
+    """The worker is shutting down; jobs stop at their next checkpoint."""
+
+
+class MusicPool:
+    """
+    Process pool for the CPU-bound music encodes, shared by the jobs of a batch or worker.
+
+    When a music process dies, ProcessPoolExecutor marks the whole pool broken
+    and fails every later submit. The first job to see that replaces the pool
+    under a lock, so the jobs after it encode again; the job itself gets the
+    BrokenProcessPool and is retried from its checkpoint.
+    """
+
+    def __init__(self, max_workers, initializer=None):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer,
+                                   mp_context=multiprocessing.get_context(MUSIC_POOL_START_METHOD))
+
+    def run(self, fn, *args):
+        """Run fn(*args) in a music process and return its result."""
+        with self._lock:
+            executor = self._executor
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    print("Music worker processes stopped unexpectedly, starting new ones")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._new_executor()
+            raise
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+def run_stage_graph(stages, max_workers=4, stop_event=None):
+    """
+    Run interdependent stages concurrently.
+
+    `stages` maps a stage name to (dependencies, function). A stage starts as
+    soon as all of its dependencies have succeeded, and is skipped if any of
+    them failed or was skipped, or once stop_event is set. Returns (results,
+    errors, skipped): results and errors are dicts keyed by stage name, skipped
+    is a set of names.
+    """
+    results, errors, skipped = {}, {}, set()
+    pending = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, (dependencies, function) in list(pending.items()):
+                stopping = stop_event is not None and stop_event.is_set()
+                if stopping or any(dep in errors or dep in skipped for dep in dependencies):
+                    skipped.add(name)
+                    del pending[name]
+                elif all(dep in results for dep in dependencies):
+                    running[executor.submit(function)] = name
+                    del pending[name]
+            if not running:
+                if pending:
+                    raise ValueError(f"Stages with unmet dependencies: {sorted(pending)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+    return results, errors, skipped
+
+
+def _timed_stage(stage, job_label, function):
+    with metrics.span(stage, job_label):
+        return function()
+
+
+def _call_timed(function, *args):
+    """Call function(*args) and return (result, seconds). Picklable, so it can run in a worker process."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_job(client, get_youtube, music_pool=None, job_label=None, poller=None, job=None, wait_for_quota=False,
+            only=None, stop_event=None):
+    """
+    Run one video through the full pipeline: idea, metadata, render, music and upload.
+
+    The stages form a small dependency graph so independent work overlaps:
+    metadata is generated while Veo renders, and the music track and YouTube
+    client are prepared alongside both, leaving the render, mux and upload on
+    the critical path. When the clip allows it, the music is muxed while the
+    clip downloads, using a StreamingMux.
+
+    get_youtube is called lazily to obtain an authenticated YouTube client so that
+    several jobs can share one. When a MusicPool is given, the CPU-bound music encode
+    runs in it instead of in the calling thread, and a shared
+    VeoPoller can be passed to multiplex render polling across jobs.
+    Each stage's output is checkpointed in `job`; passing a saved JobRecord skips
+    the stages it already completed.
+    Uploads are charged against the YouTube daily quota. When it is used up the
+    finished video is parked with status "waiting_for_quota" for --resume, or
+    with wait_for_quota=True the job sleeps until the quota resets.
+    `only` restricts the run to the named stages; the stages they depend on
+    must already be checkpointed in `job`. Once stop_event is set no further
+    stage starts. A job cut short that way, or by its music process dying, is
+    saved as "interrupted".
+    The job's niche, mascot, privacy_status and music_file fields, when set,
+    override the defaults.
+    Returns the upload response, or None if any stage failed. A run limited
+    by `only` that does not include the upload returns the job's data instead.
+    """
+    output_folder = create_output_folder()
+    store = get_artifact_store()
+    job = job or JobRecord.create()
+    job_label = job_label or job.job_id
+
+    if job.get("upload_id"):
+        print(f"[{job_label}] Already uploaded as video {job.get('upload_id')}")
+        return {"id": job.get("upload_id")}
+    if job.get("food_item"):
+        print(f"[{job_label}] Resuming job for {job.get('food_item')}")
+    job.update(status="running", failed_stage=None, error=None)
+
+    def idea_stage():
+        if not job.get("food_item"):
+            food_item, video_prompt = generate_video_idea(client, get_used_item_store().recent(IDEA_EXCLUSION_LIMIT),
+                                                          niche=job.get("niche"), mascot=job.get("mascot"))
+            job.update(food_item=food_item, video_prompt=video_prompt)
+
+    def music_track_stage():
+        if not job.get("music_file"):
+            music_file = get_random_music_track()
+            if music_file:
+                print(f"[{job_label}] Selected music track: {os.path.basename(music_file)}")
+            else:
+                print(f"[{job_label}] No music track selected, using default behavior.")
+                music_file = "sugar_rush.mp3"
+            job.update(music_file=music_file)
+
+    def require(field, stage):
+        if not job.get(field):
+            raise ValueError(f"job {job.job_id} has no {field} yet, run the {stage} stage first")
+
+    def metadata_stage():
+        require("food_item", "idea")
+        if not job.get("metadata"):
+            title, description, keywords = generate_metadata(client, job.get("food_item"), job.get("video_prompt"),
+                                                             niche=job.get("niche"), mascot=job.get("mascot"))
+            job.update(metadata={"title": title, "description": description, "keywords": keywords})
+
+    def music_output():
+        """Path for the video with music, and the cached segment (or the track itself) to mix in."""
+        music_file = job.get("music_file")
+        # Create filename for video with music in the same output folder
+        music_video_filename = f"{sanitize_filename(job.get('food_item'))}_with_music_{uuid.uuid4().hex[:8]}.mp4"
+        # Use the cached, pre-decoded segment of the track when there is one
+        music_input = music_file
+        try:
+            music_input = get_music_library().segment(music_file)
+        except Exception as e:
+            print(f"[{job_label}] Using music file directly, no cached segment: {e}")
+        return os.path.join(output_folder, music_video_filename), music_input
+
+    def render_stage():
+        require("video_prompt", "idea")
+        if _have_file(job.get("video_file")):
+            if not job.get("video_sha256") or _file_digest(job.get("video_file"), "sha256") == job.get("video_sha256"):
+                return
+            print(f"[{job_label}] {job.get('video_file')} does not match its recorded SHA-256, downloading again")
+        # Generate unique filenames and save in output folder
+        video_filename = f"{sanitize_filename(job.get('food_item'))}_{uuid.uuid4().hex[:8]}.mp4"
+        video_file = os.path.join(output_folder, video_filename)
+        try:
+            if job.get("operation_name"):
+                # The render was already paid for; pick up the same operation
+                print(f"[{job_label}] Resuming video generation {job.get('operation_name')}")
+                from google.genai import types
+
+                operation = types.GenerateVideosOperation(name=job.get("operation_name"))
+            else:
+                operation = start_video_generation(client, job.get("video_prompt"))
+                job.update(operation_name=operation.name)
+            with metrics.span("render_wait", job_label):
+                operation = wait_for_video(client, operation, poller)
+        except ShutdownRequested:
+            # Keep the operation so the next run picks up the same render
+            raise
+        except Exception:
+            # The operation failed or can no longer be polled, so render again next time
+            job.update(operation_name=None)
+            raise
+
+        # Mux the music in while the clip downloads, when the track and ffmpeg are at hand
+        streaming_mux = None
+        if job.get("music_file") and not _have_file(job.get("music_video_file")) and shutil.which(FFMPEG_BINARY):
+            video_with_music, music_input = music_output()
+            if isinstance(music_input, MusicSegment) or _have_file(music_input):
+                streaming_mux = StreamingMux(music_input, video_with_music)
+
+        try:
+            video_sha256 = save_generated_video(client, operation, video_file, consumer=streaming_mux)
+            video_file = store.put(video_file, job.job_id, "raw", video_sha256)
+        except BaseException:
+            # Stop ffmpeg and delete its partial output, which the store never tracked
+            if streaming_mux is not None:
+                streaming_mux.abort()
+            raise
+        job.update(video_file=video_file, video_sha256=video_sha256)
+        if streaming_mux is not None:
+            final_video = streaming_mux.finish()
+            metrics.increment("streaming_mux_total", result="ok" if final_video else "fallback")
+            if final_video:
+                final_video = store.put(final_video, job.job_id, "music")
+                print(f"[{job_label}] ✓ Final video with music saved to: {final_video}")
+                job.update(music_video_file=final_video)
+
+    def music_stage():
+        if _have_file(job.get("music_video_file")):
+            return
+        video_file = job.get("video_file")
+        try:
+            video_with_music, music_input = music_output()
+
+            # Add music while maintaining 9:16 aspect ratio
+            if music_pool is not None:
+                final_video, encode_seconds = music_pool.run(
+                    _call_timed, add_music_to_video, video_file, music_input, video_with_music)
+            else:
+                final_video, encode_seconds = _call_timed(add_music_to_video, video_file, music_input, video_with_music)
+            metrics.increment("encode_seconds_total", encode_seconds)
+        except BrokenProcessPool as e:
+            # The music processes died, so this says nothing about the video; mix it next time
+            raise JobInterrupted(f"music worker processes stopped: {e}") from e
+        except Exception as e:
+            if stop_event is not None and stop_event.is_set():
+                raise ShutdownRequested(f"music addition cut short by shutdown: {e}") from e
+            print(f"[{job_label}] Process failed during music addition: {e}")
+            final_video = video_file  # Use original video if music addition fails
+        if final_video == video_file and stop_event is not None and stop_event.is_set():
+            # A failed mix during shutdown was most likely killed by the signal; keep no fallback
+            raise ShutdownRequested("music addition cut short by shutdown")
+        if final_video != video_file:
+            final_video = store.put(final_video, job.job_id, "music")
+            print(f"[{job_label}] ✓ Final video with music saved to: {final_video}")
+        job.update(music_video_file=final_video)
+
+    def auth_stage():
+        youtube_clients.append(get_youtube())
+
+    def upload_stage():
+        require("metadata", "idea")
+        youtube = youtube_clients[0]
+        metadata = job.get("metadata")
+        # The video without music is uploaded when the music stage was not run
+        video_file = job.get("music_video_file") or job.get("video_file")
+        if not _have_file(video_file):
+            raise ValueError(f"job {job.job_id} has no rendered video yet, run the render stage first")
+        quota = get_youtube_quota()
+        session_key = _upload_session_key(video_file)
+        reserved = []
+
+        def reserve_quota():
+            # Called by upload_video only when it starts a new, charged insert;
+            # continuing a saved upload session costs nothing
+            if wait_for_quota:
+                quota.wait_and_reserve(YOUTUBE_UPLOAD_COST)
+            elif not quota.reserve(YOUTUBE_UPLOAD_COST):
+                raise QuotaExhausted(quota.resets_at())
+            reserved.append(YOUTUBE_UPLOAD_COST)
+
+        wait_for_rate_limit("youtube")
         upload_response = upload_video(
             youtube,
-            final_video,
-            title=title,
-            description=description,
+            video_file,
+            title=metadata["title"],
+            description=metadata["description"],
             category_id='26',  # Howto & Style - best for cooking videos
-            keywords=keywords,
-            privacy_status='public'
+            keywords=metadata["keywords"],
+            privacy_status=job.get("privacy_status") or 'public',
+            reserve_quota=reserve_quota
         )
+        if not upload_response:
+            # A session left to resume keeps its insert; otherwise nothing was charged
+            if reserved and not load_upload_session(session_key):
+                quota.release(YOUTUBE_UPLOAD_COST)
+            raise RuntimeError("upload failed")
+        job.update(status="uploaded", upload_id=upload_response['id'])
+        # The raw clip was only needed to make the uploaded video
+        if not KEEP_RAW_CLIPS and video_file != job.get("video_file"):
+            store.release(job.job_id, "raw")
+            job.update(video_file=None)
+        return upload_response
+
+    stages = {
+        "idea": ((), idea_stage),
+        "music_track": ((), music_track_stage),
+        "auth": ((), auth_stage),
+        "metadata": (("idea",), metadata_stage),
+        "render": (("idea", "music_track"), render_stage),
+        "music": (("render", "music_track"), music_stage),
+        "upload": (("music", "metadata", "auth"), upload_stage),
+    }
+    descriptions = {
+        "idea": "food item and video prompt generation",
+        "music_track": "music track selection",
+        "auth": "YouTube authentication",
+        "metadata": "metadata generation",
+        "render": "video generation or saving",
+        "music": "music addition",
+        "upload": "YouTube upload",
+    }
+    if only is not None:
+        stages = {
+            name: (tuple(dep for dep in dependencies if dep in only), function)
+            for name, (dependencies, function) in stages.items() if name in only
+        }
 
-        if upload_response:
-            print(f"✓ Upload complete! All files saved in: {output_folder}")
-            print(f"✓ Video uploaded successfully with cleaned keywords")
-        else:
-            print(f"Upload failed, but video files are still saved in: {output_folder}")
+    # Time every stage; the spans end up in the metrics export
+    stages = {
+        name: (dependencies, functools.partial(_timed_stage, name, job_label, function))
+        for name, (dependencies, function) in stages.items()
+    }
+    youtube_clients = []
+    results, errors, skipped = run_stage_graph(stages, stop_event=stop_event)
+
+    stopping = stop_event is not None and stop_event.is_set()
+    if (errors or (stopping and skipped)) and all(isinstance(error, JobInterrupted) for error in errors.values()):
+        reason = "shutdown" if stopping else "; ".join(str(error) for error in errors.values())
+        print(f"[{job_label}] Stopped ({reason}), will continue from its last checkpoint")
+        job.update(status="interrupted")
+        return None
+
+    if isinstance(errors.get("upload"), QuotaExhausted) and len(errors) == 1:
+        print(f"[{job_label}] Video is ready but not uploaded: {errors['upload']}. "
+              f"Run with --resume after the reset, or use --wait-for-quota.")
+        job.update(status="waiting_for_quota", failed_stage="upload", error=str(errors["upload"]))
+        metrics.increment("jobs_total", status="waiting_for_quota")
+        return None
+
+    if errors:
+        for name, error in errors.items():
+            print(f"[{job_label}] Process failed during {descriptions[name]}: {error}")
+        failed_stage = next(name for name in stages if name in errors)
+        job.update(status="failed", failed_stage=failed_stage, error=str(errors[failed_stage]))
+        metrics.increment("jobs_total", status="failed")
+        if _have_file(job.get("video_file")):
+            print(f"[{job_label}] Video files are still saved in: {output_folder}")
+        return None
+
+    if "upload" not in stages:
+        job.update(status="pending")
+        print(f"[{job_label}] ✓ Finished stages: {', '.join(stages)}")
+        return job.data
+
+    metrics.increment("jobs_total", status="uploaded")
+    print(f"[{job_label}] ✓ Upload complete! All files saved in: {output_folder}")
+    print(f"[{job_label}] ✓ Video uploaded successfully with cleaned keywords")
+    return results["upload"]
+
+
+def run_batch(count=1, concurrency=1, resume=False, genai_cache_mode=GENAI_CACHE_MODE, wait_for_quota=False):
+    """
+    Generate and upload `count` videos, running up to `concurrency` jobs at once.
+
+    Network-bound stages run on a thread pool while the music encode, which is
+    CPU-bound, runs on a process pool sized to the same concurrency. All renders
+    are polled by a single VeoPoller. With resume=True, every unfinished saved
+    job is continued instead of starting new ones. genai_cache_mode selects
+    the GenaiResponseCache mode for Gemini text calls, and wait_for_quota makes
+    uploads wait for the YouTube quota to reset instead of parking the job.
+    Returns the list of upload responses (None for failed jobs).
+    """
+    if resume:
+        jobs = JobRecord.unfinished()
+        if not jobs:
+            print("No unfinished jobs to resume.")
+            return []
+        print(f"Resuming {len(jobs)} unfinished job(s)")
+    else:
+        jobs = [JobRecord.create() for _ in range(count)]
+    count = len(jobs)
+    print_quota_status()
+
+    client = create_genai_client(genai_cache_mode)
+
+    # Decode music segments before any job needs them
+    get_music_library().prepare()
+
+    poller = VeoPoller(client)
+    try:
+        if count == 1:
+            return [run_job(client, get_youtube_client, poller=poller, job=jobs[0], wait_for_quota=wait_for_quota)]
+
+        concurrency = max(1, min(concurrency, count))
+        print(f"Starting batch of {count} videos with concurrency {concurrency}")
+        start = time.monotonic()
+        with MusicPool(concurrency) as music_pool, \
+                ThreadPoolExecutor(max_workers=concurrency) as job_pool:
+            futures = [
+                job_pool.submit(run_job, client, get_youtube_client, music_pool, None, poller, job, wait_for_quota)
+                for job in jobs
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        poller.close()
+        metrics.export()
+
+    uploaded = sum(1 for result in results if result)
+    print(f"Batch complete: {uploaded}/{count} videos uploaded in {time.monotonic() - start:.1f}s")
+    return results
+
+
+def run_command(command, job_id=None, genai_cache_mode=GENAI_CACHE_MODE):
+    """
+    Run one part of the pipeline for a single job: "idea", "render" or "upload".
 
+    idea starts a new job; render and upload continue the given job, or the most
+    recent unfinished one; render also picks the music track and mixes it in.
+    Only the libraries those stages need get imported, so upload never loads
+    google-genai, and moviepy only loads if the ffmpeg music mux fails.
+    Returns what run_job returns, or None if there is no job to continue.
+    """
+    if command == "idea":
+        job = JobRecord.create()
+    else:
+        job = JobRecord.find(job_id)
+        if job is None:
+            print(f"No job {job_id} found." if job_id else "No unfinished jobs to continue.")
+            return None
+    client = create_genai_client(genai_cache_mode) if command != "upload" else None
+    try:
+        return run_job(client, get_youtube_client, job=job, only=COMMAND_STAGES[command])
+    finally:
+        metrics.export()
+
+
+def create_variants(variants, job_id=None):
+    """
+    Render music and length variants of a job's Veo clip for A/B tests.
+
+    Variants without a music track use the job's track, if it has one. The
+    outputs go into the artifact store and are recorded under the job's
+    "variants" field, keyed by variant name, next to any variants rendered
+    earlier. Returns that dict, or None if the job or its clip is missing or
+    rendering fails.
+    """
+    job = JobRecord.find(job_id) if job_id else JobRecord.latest()
+    if job is None:
+        print(f"No job {job_id} found." if job_id else "No jobs found.")
+        return None
+    store = get_artifact_store()
+    video_file = store.get(job.job_id, "raw") or job.get("video_file")
+    if not _have_file(video_file):
+        # Raw clips are dropped after upload unless KEEP_RAW_CLIPS=1
+        print(f"Job {job.job_id} has no raw clip, run 'app.py render {job.job_id}' first.")
+        return None
+    variants = [variant if variant.music_file else variant._replace(music_file=job.get("music_file"))
+                for variant in variants]
+    base_name = sanitize_filename(job.get("food_item"))
+    output_files = {variant.name: os.path.join(create_output_folder(),
+                                               f"{base_name}_{variant.name}_{uuid.uuid4().hex[:8]}.mp4")
+                    for variant in variants}
+    try:
+        with metrics.span("variants", job.job_id):
+            render_variants(video_file, variants, output_files)
     except Exception as e:
-        print(f"Process failed during YouTube upload: {e}")
-        print(f"Video files are still saved in: {output_folder}")
+        print(f"[{job.job_id}] Process failed during variant rendering: {e}")
+        return None
+    finally:
+        metrics.export()
+
+    recorded = dict(job.get("variants") or {})
+    for variant in variants:
+        output_file = store.put(output_files[variant.name], job.job_id, f"variant:{variant.name}")
+        recorded[variant.name] = {"file": output_file, "music_file": variant.music_file,
+                                  "volume": variant.volume if variant.music_file else None,
+                                  "duration": variant.duration}
+        print(f"[{job.job_id}] ✓ Variant {variant.name} saved to: {output_file}")
+    job.update(variants=recorded)
+    return recorded
+
+
+def show_storage(job_id=None, max_gb=None):
+    """Print the artifact store's size and a job's files, evicting down to max_gb first if given."""
+    store = get_artifact_store()
+    if max_gb is not None:
+        evicted = store.enforce_limit(int(max_gb * 1024 ** 3))
+        print(f"Evicted {len(evicted)} video(s)")
+    count, size = store.usage()
+    print(f"{count} video(s), {size / 1024 ** 2:.1f} MB of {store.max_bytes / 1024 ** 3:.1f} GB in {store.root}")
+    if job_id:
+        artifacts = store.artifacts(job_id)
+        if not artifacts:
+            print(f"No stored videos for job {job_id}.")
+        for kind, path in artifacts.items():
+            print(f"  {kind:16s} {path}")
+
+
+def _ignore_shutdown_signals():
+    """
+    Initializer for the worker's music processes: leave SIGINT and SIGTERM to the worker.
+
+    The processes also move to their own process group, so a Ctrl+C in the
+    terminal does not reach them or their ffmpeg children. The worker stops
+    them itself once the running encodes are done.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+
+def _process_request(queue, request, client, music_pool, poller, stop_event):
+    """Run the job of one queued request and record the outcome in the queue."""
+    job = JobRecord.find(request.job_id) if request.job_id else None
+    if job is None:
+        job = JobRecord.create(**request.options)
+        queue.set_job(request.id, job.job_id)
+    label = f"request {request.id}"
+    try:
+        result = run_job(client, get_youtube_client, music_pool, label, poller, job, stop_event=stop_event)
+    except Exception as e:
+        print(f"[{label}] Process failed during job: {e}")
+        job.update(status="failed", error=str(e))
+        result = None
+
+    status = job.get("status")
+    if result:
+        queue.finish(request.id)
+    elif status == "interrupted":
+        queue.retry(request.id, count_attempt=False)
+    elif status == "waiting_for_quota":
+        delay = get_youtube_quota().resets_at() - time.time() + 60
+        queue.retry(request.id, delay=delay, error=job.get("error"), count_attempt=False)
+    elif request.attempts < WORKER_MAX_ATTEMPTS:
+        print(f"[{label}] Will retry (attempt {request.attempts}/{WORKER_MAX_ATTEMPTS})")
+        queue.retry(request.id, delay=WORKER_RETRY_DELAY * request.attempts, error=job.get("error"))
+    else:
+        queue.finish(request.id, "failed", job.get("error"))
+    metrics.export()
+
+
+def run_worker(concurrency=DEFAULT_BATCH_CONCURRENCY, genai_cache_mode=GENAI_CACHE_MODE, exit_when_idle=False):
+    """
+    Process queued requests until SIGTERM or SIGINT, keeping clients warm between videos.
+
+    The genai client, YouTube client, music cache and music worker processes
+    are set up once for all videos; the music folder is rescanned, and new
+    tracks decoded, whenever a request is claimed. A request is only claimed when one of the
+    `concurrency` slots is free, so waiting work stays in the queue, where
+    another worker can take it. On a shutdown signal no new request or stage
+    starts, renders stop being polled (their operations are checkpointed), and
+    unfinished requests go back to the queue to continue on the next start.
+    The leases on running requests are renewed while the worker lives, so
+    other workers only take over the requests of one that died.
+    With exit_when_idle=True the worker also stops once the queue is empty.
+    """
+    queue = JobQueue()
+    recovered = queue.recover()
+    if recovered:
+        print(f"Requeued {recovered} request(s) whose worker stopped renewing its lease")
+
+    # Renew the leases from a thread of its own, so a long music prepare or
+    # shutdown wait never lets another worker take over running requests
+    heartbeat_stop = threading.Event()
+
+    def heartbeat():
+        while not heartbeat_stop.wait(queue.lease_seconds / 4):
+            queue.renew()
+
+    heartbeat_thread = threading.Thread(target=heartbeat, name="queue-heartbeat", daemon=True)
+    heartbeat_thread.start()
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if not stop.is_set():
+            print(f"Received {signal.Signals(signum).name}, stopping after the running stages")
+        stop.set()
+
+    previous_handlers = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    client = create_genai_client(genai_cache_mode)
+    get_music_library().prepare()
+    poller = VeoPoller(client)
+    print(f"Worker started with concurrency {concurrency}, queue {queue.path}: {queue.counts()}")
+    try:
+        with MusicPool(concurrency, initializer=_ignore_shutdown_signals) as music_pool, \
+                ThreadPoolExecutor(max_workers=concurrency) as job_pool:
+            running = set()
+            while not stop.is_set():
+                running = {future for future in running if not future.done()}
+                if len(running) >= concurrency:
+                    # Backpressure: claim nothing until a slot frees up
+                    wait(running, timeout=WORKER_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                    continue
+                request = queue.claim()
+                if request is None:
+                    if exit_when_idle and not running:
+                        break
+                    stop.wait(WORKER_POLL_INTERVAL)
+                    continue
+                print(f"Claimed request {request.id} (attempt {request.attempts}): {request.options}")
+                # Pick up tracks added, replaced or removed since the last request (unchanged files are
+                # only stat'ed) and decode new segments here, so no job decodes an MP3 itself
+                music_library = get_music_library()
+                music_library.refresh()
+                music_library.prepare()
+                running.add(job_pool.submit(_process_request, queue, request, client, music_pool, poller, stop))
+
+            if running:
+                print(f"Waiting for {len(running)} running job(s) to reach a checkpoint...")
+                poller.cancel_pending(ShutdownRequested("worker is shutting down"))
+                wait(running)
+    finally:
+        poller.close()
+        metrics.export()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+        heartbeat_stop.set()
+        heartbeat_thread.join()
+        print(f"Worker stopped, queue: {queue.counts()}")
+        queue.close()
+
+
+def enqueue_requests(count=1, niche=None, mascot=None, privacy_status=None, music_file=None):
+    """
+    Queue `count` video requests for the worker. Returns the ids of the queued requests.
+
+    Stops early when the queue already holds WORKER_MAX_QUEUED waiting requests.
+    """
+    if music_file and not os.path.exists(music_file):
+        raise FileNotFoundError(f"Music track {music_file} not found")
+    options = {key: value for key, value in (("niche", niche), ("mascot", mascot), ("privacy_status", privacy_status),
+                                             ("music_file", music_file and os.path.abspath(music_file))) if value}
+    queue = JobQueue()
+    try:
+        request_ids = []
+        for _ in range(count):
+            request_id = queue.enqueue(options)
+            if request_id is None:
+                print(f"Queue is full ({WORKER_MAX_QUEUED} requests waiting), try again later")
+                break
+            request_ids.append(request_id)
+        print(f"Queued {len(request_ids)} request(s) {request_ids}, queue: {queue.counts()}")
+        return request_ids
+    finally:
+        queue.close()
+
+
+def main():
+    """Main function to orchestrate the video generation and upload process."""
+    parser = argparse.ArgumentParser(description="Generate and upload AI YouTube Shorts.")
+    parser.add_argument("--count", type=int, default=1, help="number of videos to generate (default: 1)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY,
+                        help=f"number of videos to work on at once (default: {DEFAULT_BATCH_CONCURRENCY})")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue unfinished jobs from their first incomplete stage instead of starting new ones")
+    parser.add_argument("--genai-cache", choices=GenaiResponseCache.MODES, default=GENAI_CACHE_MODE,
+                        help="cache Gemini text responses: cache, record, or replay recorded ones offline "
+                             f"(default: {GENAI_CACHE_MODE}, set with GENAI_CACHE_MODE)")
+    parser.add_argument("--wait-for-quota", action="store_true",
+                        help="when the YouTube daily quota is used up, wait for it to reset instead of "
+                             "leaving finished videos for --resume")
+    parser.add_argument("--quota", action="store_true", help="show the remaining YouTube quota and exit")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND",
+                                       help="run one part of the pipeline instead of the whole pipeline")
+    subparsers.add_parser("idea", help="start a job with a new food item, video prompt and metadata")
+    for command, help_text in (("render", "render and download the video of a job"),
+                               ("upload", "upload the finished video of a job")):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("job_id", nargs="?", help="job to continue (default: the most recent unfinished job)")
+    enqueue = subparsers.add_parser("enqueue", help="queue video requests for a worker")
+    enqueue.add_argument("--count", type=int, default=1, help="number of videos to queue (default: 1)")
+    enqueue.add_argument("--niche", help="channel niche for the idea and metadata, e.g. 'bubble tea drinks'")
+    enqueue.add_argument("--mascot", help="mascot to use instead of Zesty, e.g. 'a grumpy penguin barista'")
+    enqueue.add_argument("--privacy", choices=["public", "unlisted", "private"], help="privacy status (default: public)")
+    enqueue.add_argument("--music", help="music track to use instead of a random one")
+    worker = subparsers.add_parser("worker", help="process queued requests until stopped")
+    worker.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY,
+                        help=f"videos to work on at once (default: {DEFAULT_BATCH_CONCURRENCY})")
+    worker.add_argument("--exit-when-idle", action="store_true", help="stop once the queue is empty")
+    subparsers.add_parser("queue", help="show how many requests are queued, running, done and failed")
+    storage = subparsers.add_parser("storage", help="show the stored videos and their disk use")
+    storage.add_argument("job_id", nargs="?", help="also list the files of this job")
+    storage.add_argument("--max-gb", type=float,
+                         help="evict least recently used videos until the store fits in this many GB")
+    variants = subparsers.add_parser("variants", help="render music and length variants of a job's video in one pass")
+    variants.add_argument("job_id", nargs="?", help="job whose clip to use (default: the most recent job)")
+    variants.add_argument("--variant", dest="variants", action="append", type=parse_variant, required=True,
+                          metavar="NAME[:music=PATH,volume=V,duration=S]",
+                          help="an output to render; repeat for each variant")
+    args = parser.parse_args()
+
+    if args.quota:
+        print_quota_status()
         return
+    if args.command == "enqueue":
+        if args.count < 1:
+            parser.error("--count must be at least 1")
+        queued = enqueue_requests(args.count, args.niche, args.mascot, args.privacy, args.music)
+        # A non-zero exit tells feeders such as cron to back off
+        raise SystemExit(0 if len(queued) == args.count else 1)
+    if args.command == "worker":
+        if args.concurrency < 1:
+            parser.error("--concurrency must be at least 1")
+        run_worker(args.concurrency, genai_cache_mode=args.genai_cache, exit_when_idle=args.exit_when_idle)
+        return
+    if args.command == "queue":
+        queue = JobQueue()
+        print(f"Queue {queue.path}: {queue.counts() or 'empty'}")
+        queue.close()
+        return
+    if args.command == "storage":
+        show_storage(args.job_id, args.max_gb)
+        return
+    if args.command == "variants":
+        names = [variant.name for variant in args.variants]
+        if len(set(names)) != len(names):
+            parser.error("variant names must be unique")
+        missing = [variant.music_file for variant in args.variants
+                   if variant.music_file and not os.path.exists(variant.music_file)]
+        if missing:
+            parser.error(f"music track not found: {missing[0]}")
+        raise SystemExit(0 if create_variants(args.variants, args.job_id) else 1)
+    if args.command:
+        run_command(args.command, getattr(args, "job_id", None), genai_cache_mode=args.genai_cache)
+        return
+    if args.count < 1 or args.concurrency < 1:
+        parser.error("--count and --concurrency must be at least 1")
+
+    run_batch(count=args.count, concurrency=args.concurrency, resume=args.resume,
+              genai_cache_mode=args.genai_cache, wait_for_quota=args.wait_for_quota)
 
 
 if __name__ == '__main__':
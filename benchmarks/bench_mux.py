@@ -0,0 +1,100 @@
+"""
+Compare the two ways of adding music to an 8-second Veo-sized clip.
+
+- copy:    ffmpeg stream-copies the H.264 video and only encodes the AAC audio
+- moviepy: every frame is decoded and re-encoded with libx264
+
+Synthetic test media is generated with ffmpeg unless --video/--music are given.
+Reports wall time and CPU time (this process plus its ffmpeg children) per clip.
+
+    python benchmarks/bench_mux.py --runs 5 --json mux_results.json
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+
+def make_sample_media(workdir, duration=8):
+    """Create a 720x1280 H.264 clip and an MP3 track like the ones the pipeline handles."""
+    ffmpeg = shutil.which(app.FFMPEG_BINARY)
+    video_file = os.path.join(workdir, "sample.mp4")
+    music_file = os.path.join(workdir, "sample.mp3")
+    subprocess.run([ffmpeg, '-y', '-nostdin', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f'testsrc2=size=720x1280:rate=24:duration={duration}',
+                    '-c:v', 'libx264', '-pix_fmt', 'yuv420p', video_file], check=True)
+    subprocess.run([ffmpeg, '-y', '-nostdin', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440:duration=30',
+                    '-ac', '2', music_file], check=True)
+    return video_file, music_file
+
+
+def cpu_seconds():
+    """User + system CPU time of this process and its waited-for children."""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def run_trials(mux, video_file, music_file, workdir, runs):
+    """Time `runs` calls of a mux function, returning per-run wall and CPU seconds."""
+    wall, cpu = [], []
+    for n in range(runs):
+        output_file = os.path.join(workdir, f"{mux.__name__}_{n}.mp4")
+        start_wall, start_cpu = time.perf_counter(), cpu_seconds()
+        mux(video_file, music_file, output_file)
+        wall.append(time.perf_counter() - start_wall)
+        cpu.append(cpu_seconds() - start_cpu)
+        os.remove(output_file)
+    return {
+        "runs": runs,
+        "wall_median_s": statistics.median(wall),
+        "wall_min_s": min(wall),
+        "cpu_median_s": statistics.median(cpu),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="runs per method (default: 3)")
+    parser.add_argument("--video", help="clip to use instead of a generated one")
+    parser.add_argument("--music", help="music track to use instead of a generated one")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    args = parser.parse_args()
+
+    if not shutil.which(app.FFMPEG_BINARY):
+        sys.exit(f"{app.FFMPEG_BINARY} not found on PATH")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        video_file, music_file = make_sample_media(workdir)
+        video_file = args.video or video_file
+        music_file = args.music or music_file
+
+        results = {
+            "copy": run_trials(app.mux_music_with_ffmpeg, video_file, music_file, workdir, args.runs),
+            "moviepy": run_trials(app.mux_music_with_moviepy, video_file, music_file, workdir, args.runs),
+        }
+
+    for method, result in results.items():
+        print(f"{method:8s} wall {result['wall_median_s']:6.2f}s (min {result['wall_min_s']:.2f}s)  "
+              f"cpu {result['cpu_median_s']:6.2f}s")
+    speedup = results["moviepy"]["wall_median_s"] / results["copy"]["wall_median_s"]
+    print(f"stream copy is {speedup:.1f}x faster per clip")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
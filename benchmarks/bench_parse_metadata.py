@@ -0,0 +1,90 @@
+"""
+Measure parse_metadata over a corpus of well-formed and malformed metadata responses.
+
+The corpus (benchmarks/data/metadata_responses.json) holds one entry per
+failure shape seen from Gemini: inner quotes, raw newlines, trailing or
+missing commas, truncation at the token limit, keyword strings, code fences
+with surrounding text. Each entry records the title and keyword count a
+correct parse must produce, or for hopeless input the exception it must
+raise (instead of hanging). Append real responses to the file as they turn up.
+
+    python benchmarks/bench_parse_metadata.py --repeat 200 --json parse_results.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "metadata_responses.json")
+
+
+def check(entry):
+    """Parse one response and compare it with the expected result. Returns (ok, error)."""
+    expect = entry["expect"]
+    try:
+        title, description, keywords = app.parse_metadata(entry["text"])
+    except Exception as e:
+        if type(e).__name__ == expect.get("error"):
+            return True, None
+        return False, f"{type(e).__name__}: {e}"
+    if "error" in expect:
+        return False, f"expected {expect['error']}, got title {title!r}"
+    if title != expect["title"]:
+        return False, f"title {title!r} != {expect['title']!r}"
+    if len(keywords) != expect["keywords"]:
+        return False, f"{len(keywords)} keywords, expected {expect['keywords']}"
+    return True, None
+
+
+def time_parse(entry, repeat):
+    """Median-free mean time per parse in microseconds, with parse_metadata's output silenced."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            try:
+                app.parse_metadata(entry["text"])
+            except Exception:
+                pass
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="JSON corpus of responses")
+    parser.add_argument("--repeat", type=int, default=100, help="parses per response for timing (default: 100)")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    args = parser.parse_args()
+
+    with open(args.corpus, 'r') as f:
+        corpus = json.load(f)
+
+    results = []
+    for entry in corpus:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok, error = check(entry)
+        microseconds = time_parse(entry, args.repeat)
+        results.append({"name": entry["name"], "ok": ok, "error": error, "us_per_parse": microseconds})
+        status = "ok  " if ok else "FAIL"
+        print(f"{status} {entry['name']:32s} {microseconds:8.1f} us" + (f"  ({error})" if error else ""))
+
+    passed = sum(1 for result in results if result["ok"])
+    mean_us = sum(result["us_per_parse"] for result in results) / len(results)
+    print(f"\nParsed {passed}/{len(results)} responses correctly ({passed / len(results):.0%}), "
+          f"mean {mean_us:.1f} us per response")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"success_rate": passed / len(results), "mean_us_per_parse": mean_us,
+                       "responses": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+Run the whole pipeline offline and time every stage.
+
+Gemini and Veo are replaced by fakes.FakeGenaiClient and YouTube by
+fake_youtube.FakeYouTubeServer, so no API keys or quota are needed. Music is
+mixed from a generated test tone with the real ffmpeg code path.
+
+Two measurements are taken:
+- stages: `--runs` single-video jobs with idea, metadata, render submit, render
+  wait, save, add_music_to_video and upload_video timed separately
+- batch:  one run_batch of `--batch` videos at `--concurrency`, for throughput
+
+Results can be written as JSON and compared with an earlier run; the script
+exits with status 1 when a stage or the batch got slower than `--tolerance`.
+
+    python benchmarks/bench_pipeline.py --json pipeline.json
+    python benchmarks/bench_pipeline.py --compare pipeline.json --tolerance 0.25
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import app  # noqa: E402
+import google.genai  # noqa: E402
+from fake_youtube import FakeYouTubeServer  # noqa: E402
+from fakes import FakeGenaiClient, make_sample_music, make_sample_video  # noqa: E402
+
+# app functions timed in the stage measurement, in pipeline order
+TIMED_STAGES = {
+    "idea": "generate_video_idea",
+    "metadata": "generate_metadata",
+    "render_submit": "start_video_generation",
+    "render_wait": "wait_for_video",
+    "save": "save_generated_video",
+    "music": "add_music_to_video",
+    "upload": "upload_video",
+}
+
+# Slowdowns smaller than this are timer noise, whatever the relative change
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def regressed(before, after, tolerance):
+    return after - before > max(before * tolerance, MIN_REGRESSION_SECONDS)
+
+
+class StageTimer:
+    """Replace app functions with wrappers that record how long each call took."""
+
+    def __init__(self):
+        self.timings = {stage: [] for stage in TIMED_STAGES}
+        self._originals = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        for stage, name in TIMED_STAGES.items():
+            original = getattr(app, name)
+            self._originals[name] = original
+            setattr(app, name, self._wrap(stage, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self._originals.items():
+            setattr(app, name, original)
+
+    def _wrap(self, stage, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.timings[stage].append(time.perf_counter() - start)
+        return timed
+
+
+def summarize(seconds):
+    if not seconds:
+        return {"calls": 0}
+    return {"calls": len(seconds), "median_s": statistics.median(seconds), "min_s": min(seconds), "max_s": max(seconds)}
+
+
+def run_stages(runs, verbose):
+    """Run `runs` single-video jobs one after another with every stage timed."""
+    job_seconds = []
+    with StageTimer() as timer:
+        for _ in range(runs):
+            start = time.perf_counter()
+            with quiet(verbose):
+                app.run_batch(count=1, genai_cache_mode="off")
+            job_seconds.append(time.perf_counter() - start)
+    return {stage: summarize(seconds) for stage, seconds in timer.timings.items()}, summarize(job_seconds)
+
+
+def run_throughput(count, concurrency, verbose):
+    """Time one batch of `count` videos and return its throughput."""
+    start = time.perf_counter()
+    with quiet(verbose):
+        results = app.run_batch(count=count, concurrency=concurrency, genai_cache_mode="off")
+    wall = time.perf_counter() - start
+    uploaded = sum(1 for result in results if result)
+    return {
+        "count": count,
+        "concurrency": concurrency,
+        "uploaded": uploaded,
+        "wall_s": wall,
+        "videos_per_minute": uploaded / wall * 60,
+    }
+
+
+def quiet(verbose):
+    """Silence the pipeline's progress output unless --verbose was given."""
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def compare(results, baseline, tolerance):
+    """List the stage medians and batch wall time that regressed by more than `tolerance`."""
+    regressions = []
+    for stage, summary in results["stages"].items():
+        before = baseline.get("stages", {}).get(stage, {}).get("median_s")
+        after = summary.get("median_s")
+        if before and after and regressed(before, after, tolerance):
+            regressions.append(f"{stage}: {before:.3f}s -> {after:.3f}s")
+    before = baseline.get("batch", {}).get("wall_s")
+    after = results["batch"]["wall_s"]
+    if before and regressed(before, after, tolerance):
+        regressions.append(f"batch: {before:.2f}s -> {after:.2f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="single-video jobs for stage timings (default: 3)")
+    parser.add_argument("--batch", type=int, default=4, help="videos in the throughput batch (default: 4)")
+    parser.add_argument("--concurrency", type=int, default=app.DEFAULT_BATCH_CONCURRENCY,
+                        help=f"batch concurrency (default: {app.DEFAULT_BATCH_CONCURRENCY})")
+    parser.add_argument("--text-latency", type=float, default=0.5, help="seconds per fake Gemini call (default: 0.5)")
+    parser.add_argument("--render-latency", type=float, default=6.0, help="seconds per fake Veo render (default: 6)")
+    parser.add_argument("--upload-latency", type=float, default=0.0, help="seconds added to every upload chunk")
+    parser.add_argument("--chunk-size", type=int, help="upload chunk size in bytes (default: UPLOAD_CHUNK_SIZE)")
+    parser.add_argument("--no-faststart", action="store_true",
+                        help="render clips with the moov box at the end, so music is muxed after the download")
+    parser.add_argument("--json", help="write results to this JSON file")
+    parser.add_argument("--compare", help="earlier results JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown against --compare before failing (default: 0.2)")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    if not shutil.which(app.FFMPEG_BINARY):
+        sys.exit(f"{app.FFMPEG_BINARY} not found on PATH")
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # app keeps its databases, jobs and videos relative to the working directory
+        os.chdir(workdir)
+        server = FakeYouTubeServer(latency=args.upload_latency)
+        try:
+            music_dir = os.path.join(workdir, "music_tracks")
+            os.makedirs(music_dir)
+            make_sample_music(os.path.join(music_dir, "tone.mp3"), ffmpeg=app.FFMPEG_BINARY)
+            sample_video = make_sample_video(os.path.join(workdir, "sample.mp4"), ffmpeg=app.FFMPEG_BINARY,
+                                             faststart=not args.no_faststart)
+
+            client = FakeGenaiClient(sample_video, text_latency=args.text_latency,
+                                     render_latency=args.render_latency, idea_candidates=app.IDEA_CANDIDATES)
+            # app imports google.genai lazily, so patch the class it will look up
+            google.genai.Client = lambda **kwargs: client
+            # httplib2 connections are not thread-safe, so every job gets its own client
+            app.get_youtube_client = server.youtube_client
+            app._music_library = app.MusicLibrary(music_dir, os.path.join(workdir, "music_cache"))
+            app.VEO_POLL_DEFAULT_ESTIMATE = args.render_latency
+            # The fakes have no rate limits or daily quota to protect
+            app.API_RATE_LIMITS = {api: 1e6 for api in app.API_RATE_LIMITS}
+            app.YOUTUBE_DAILY_QUOTA = 10 ** 9
+            if args.chunk_size:
+                app.upload_video = functools.partial(app.upload_video, chunk_size=args.chunk_size)
+
+            stages, job = run_stages(args.runs, args.verbose)
+            batch = run_throughput(args.batch, args.concurrency, args.verbose)
+            api_calls = dict(client.calls, upload_chunks=server.chunk_requests)
+        finally:
+            server.close()
+            os.chdir(cwd)
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("json", "compare", "verbose")},
+        "stages": stages,
+        "job": job,
+        "batch": batch,
+        "api_calls": api_calls,
+    }
+
+    for stage, summary in stages.items():
+        if summary["calls"]:
+            print(f"{stage:14s} median {summary['median_s']:7.3f}s  min {summary['min_s']:7.3f}s  "
+                  f"max {summary['max_s']:7.3f}s  ({summary['calls']} calls)")
+    print(f"{'job':14s} median {job['median_s']:7.3f}s")
+    print(f"batch: {batch['uploaded']}/{batch['count']} videos at concurrency {batch['concurrency']} "
+          f"in {batch['wall_s']:.2f}s ({batch['videos_per_minute']:.1f} videos/min)")
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\nSlower than {args.compare} by more than {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
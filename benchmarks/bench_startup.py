@@ -0,0 +1,88 @@
+"""
+Measure cold start: how long app.py takes before it does any real work.
+
+Every scenario runs in a fresh interpreter, so nothing is cached in-process:
+- import_app:      `import app`
+- cli_help:        `python app.py --help`
+- cli_quota:       `python app.py --quota`, a command that needs no API client
+- idea_imports:    app plus the modules the idea and render commands load
+- upload_imports:  app plus the modules the upload command loads
+- youtube_client:  building the YouTube client from the bundled discovery document
+- moviepy_import:  the moviepy fallback, which only loads when ffmpeg fails
+
+It also lists which heavy libraries `import app` loads (ideally none).
+
+    python benchmarks/bench_startup.py --runs 10 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP = os.path.join(ROOT, "app.py")
+
+# Libraries that should only be imported by the stages that use them
+HEAVY_MODULES = ["google.genai", "googleapiclient", "google_auth_oauthlib", "httplib2", "numpy", "moviepy"]
+
+SCENARIOS = {
+    "import_app": ["-c", "import app"],
+    "cli_help": [APP, "--help"],
+    "cli_quota": [APP, "--quota"],
+    "idea_imports": ["-c", "import app; from google import genai; from google.genai import types"],
+    "upload_imports": ["-c", "import app, google_auth_httplib2, httplib2, googleapiclient.http; "
+                             "from googleapiclient.discovery import build; "
+                             "from google_auth_oauthlib.flow import InstalledAppFlow"],
+    "youtube_client": ["-c", "from googleapiclient.discovery import build; "
+                             "build('youtube', 'v3', developerKey='benchmark', static_discovery=True)"],
+    "moviepy_import": ["-c", "import moviepy.editor"],
+}
+
+
+def time_command(args, workdir):
+    """Wall time of one fresh interpreter running `args`."""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=workdir, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def heavy_modules_loaded(workdir):
+    """Heavy libraries present in sys.modules right after `import app`."""
+    code = ("import sys, json, app; "
+            f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=dict(os.environ, PYTHONPATH=ROOT),
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="runs per scenario (default: 5)")
+    parser.add_argument("--json", help="also write results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        # Warm the OS file cache once so every scenario measures the same thing
+        time_command(["-c", "import app"], workdir)
+        for name, command in SCENARIOS.items():
+            seconds = [time_command(command, workdir) for _ in range(args.runs)]
+            results[name] = {"runs": args.runs, "median_s": statistics.median(seconds), "min_s": min(seconds)}
+            print(f"{name:16s} median {results[name]['median_s']:6.3f}s  min {results[name]['min_s']:6.3f}s")
+        loaded = heavy_modules_loaded(workdir)
+
+    print(f"\nHeavy modules loaded by `import app`: {', '.join(loaded) if loaded else 'none'}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"scenarios": results, "heavy_modules_on_import": loaded}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Local stand-in for the YouTube resumable upload endpoint.
+
+Implements just enough of the protocol used by videos().insert: the POST that
+opens a session, chunked PUTs answered with 308 + Range, the empty
+"bytes */total" status query, and a final 200 with a video resource. Faults
+can be injected (5xx responses or dropped connections every N chunks) to
+exercise upload_video's retry and resume logic.
+
+    server = FakeYouTubeServer(fail_every=3)
+    youtube = server.youtube_client()
+    app.upload_video(youtube, "clip.mp4", ...)
+
+Run directly to upload a file through the fake endpoint and print throughput:
+
+    python benchmarks/fake_youtube.py clip.mp4 --fail-every 3 --chunk-size 262144
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class FakeYouTubeServer:
+    """Threaded HTTP server speaking the resumable upload protocol on localhost."""
+
+    def __init__(self, fail_every=0, fail_mode="503", latency=0.0, port=0):
+        self.fail_every = fail_every
+        self.fail_mode = fail_mode  # "503" or "drop"
+        self.latency = latency
+        self.sessions = {}  # session id -> {"body", "data", "total"}
+        self.uploaded = []  # finished video resources
+        self.chunk_requests = 0
+        self._chunk_counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}/"
+
+    def youtube_client(self):
+        """Build a YouTube API client whose requests go to this server."""
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+
+        # Point the bundled discovery document at this server (plain http)
+        document = json.loads(get_static_doc('youtube', 'v3'))
+        document['rootUrl'] = self.url
+        return build_from_document(document, developerKey='fake')
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _send(self, status, headers=None, body=b''):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self._read_body()
+                if 'uploadType=resumable' not in self.path:
+                    self._send(400)
+                    return
+                session_id = uuid.uuid4().hex
+                with server._lock:
+                    server.sessions[session_id] = {
+                        "body": json.loads(body or b'{}'),
+                        "data": bytearray(),
+                        "total": int(self.headers.get('X-Upload-Content-Length') or 0),
+                    }
+                self._send(200, {'Location': f"{server.url}upload/session/{session_id}"})
+
+            def do_PUT(self):
+                match = re.match(r'/upload/session/(\w+)', self.path)
+                session = server.sessions.get(match.group(1)) if match else None
+                if session is None:
+                    self._read_body()
+                    self._send(404)
+                    return
+
+                content_range = self.headers.get('Content-Range', '')
+                status_query = re.match(r'bytes \*/(\d+|\*)', content_range)
+                if not status_query:
+                    chunk_number = next(server._chunk_counter)
+                    if server.fail_every and chunk_number % server.fail_every == 0:
+                        # Fail before accepting the chunk, like a dropped request would
+                        if server.fail_mode == "drop":
+                            self.close_connection = True
+                            self.connection.close()
+                            return
+                        self._read_body()
+                        self._send(503)
+                        return
+
+                data = self._read_body()
+                if server.latency:
+                    time.sleep(server.latency)
+
+                with server._lock:
+                    if not status_query:
+                        server.chunk_requests += 1
+                        start, end, total = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range).groups()
+                        if int(start) == len(session["data"]):
+                            session["data"].extend(data)
+                        if total != '*':
+                            session["total"] = int(total)
+                    received = len(session["data"])
+                    complete = session["total"] and received >= session["total"]
+                    if complete and "resource" not in session:
+                        session["resource"] = dict(session["body"], id=uuid.uuid4().hex[:11], kind="youtube#video")
+                        server.uploaded.append(session["resource"])
+
+                if complete:
+                    self._send(200, {'Content-Type': 'application/json'},
+                               json.dumps(session["resource"]).encode())
+                elif received:
+                    self._send(308, {'Range': f"bytes=0-{received - 1}"})
+                else:
+                    self._send(308)
+
+        return Handler
+
+
+def main():
+    import app
+
+    parser = argparse.ArgumentParser(description="Upload a file to a local fake YouTube endpoint.")
+    parser.add_argument("video_file")
+    parser.add_argument("--chunk-size", type=int, default=app.UPLOAD_CHUNK_SIZE)
+    parser.add_argument("--fail-every", type=int, default=0, help="fail every Nth chunk request (0 = never)")
+    parser.add_argument("--fail-mode", choices=["503", "drop"], default="503")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every chunk")
+    args = parser.parse_args()
+
+    server = FakeYouTubeServer(fail_every=args.fail_every, fail_mode=args.fail_mode, latency=args.latency)
+    try:
+        response = app.upload_video(
+            server.youtube_client(), args.video_file,
+            title="Fake upload", description="Uploaded to the local fake endpoint",
+            category_id='26', keywords=["benchmark"], privacy_status='private',
+            chunk_size=args.chunk_size)
+        print(f"Response: {response}")
+        print(f"Chunk requests accepted: {server.chunk_requests}")
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+Local stand-in for the genai.Client used by app.py.
+
+FakeGenaiClient answers the calls the pipeline makes (models.generate_content,
+models.generate_videos, operations.get, files.download) with canned responses
+after a configurable delay. Idea responses always carry fresh food items, and
+renders become done once `render_latency` seconds have passed and save a
+sample MP4 as the generated clip.
+
+    client = FakeGenaiClient(sample_video, text_latency=0.5, render_latency=5)
+    google.genai.Client = lambda **kwargs: client
+
+Together with fake_youtube.FakeYouTubeServer this lets the whole pipeline run
+offline; see bench_pipeline.py.
+"""
+import itertools
+import json
+import shutil
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+
+IDEA_PROMPT = """[0.0s–2s] → Zesty pours the base into a tall glass, top-down shot, ASMR splash
+[2s–4s] → Macro shot of the {item} being layered, bubbly sound
+[4s–6s] → Side-shot as Zesty adds toppings with a cartoon "boing"
+[6s–8s] → Hero shot, Zesty winks, overlay text "{item}!", meow sound effect"""
+
+
+def make_sample_video(path, duration=8, ffmpeg="ffmpeg", faststart=True):
+    """Create a 720x1280 H.264 clip with silent audio, shaped like a Veo render.
+
+    With faststart=False the moov box is written after the media data, which
+    stops app.StreamingMux from muxing during the download.
+    """
+    subprocess.run([ffmpeg, '-y', '-nostdin', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f'testsrc2=size=720x1280:rate=24:duration={duration}',
+                    '-f', 'lavfi', '-i', 'anullsrc=channel_layout=stereo:sample_rate=48000',
+                    '-shortest', '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                    '-c:a', 'aac', *(['-movflags', '+faststart'] if faststart else []), path], check=True)
+    return path
+
+
+def make_sample_music(path, duration=30, ffmpeg="ffmpeg"):
+    """Create a stereo MP3 test tone for the music_tracks folder."""
+    subprocess.run([ffmpeg, '-y', '-nostdin', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                    '-ac', '2', path], check=True)
+    return path
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeVideo:
+    """A generated video whose save() copies the sample clip."""
+
+    def __init__(self, sample_video):
+        self.sample_video = sample_video
+        self.uri = None
+        self.video_bytes = None
+
+    def save(self, path):
+        shutil.copyfile(self.sample_video, path)
+
+
+class FakeOperation:
+    """Snapshot of a render operation, like types.GenerateVideosOperation."""
+
+    def __init__(self, name, done, sample_video=None):
+        self.name = name
+        self.done = done
+        self.error = None
+        self.response = None
+        if done:
+            self.response = SimpleNamespace(generated_videos=[SimpleNamespace(video=FakeVideo(sample_video))])
+
+
+class FakeModels:
+    def __init__(self, client):
+        self._client = client
+
+    def generate_content(self, *, model, contents, config=None):
+        client = self._client
+        client._count("generate_content")
+        time.sleep(client.text_latency)
+        if config is not None and getattr(config, "response_mime_type", None) == "application/json":
+            return FakeResponse(json.dumps(client.metadata))
+        blocks = []
+        for _ in range(client.idea_candidates):
+            item = f"Benchmark Float {next(client._items)}"
+            blocks.append(f"Food Item: {item}\n" + IDEA_PROMPT.format(item=item))
+        return FakeResponse("\n---\n".join(blocks))
+
+    def generate_videos(self, *, model, prompt, config=None):
+        client = self._client
+        client._count("generate_videos")
+        time.sleep(client.text_latency)
+        name = f"models/veo/operations/fake-{next(client._operations)}"
+        with client._lock:
+            client._render_ready_at[name] = time.monotonic() + client.render_latency
+        return FakeOperation(name, False)
+
+
+class FakeOperations:
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, operation):
+        client = self._client
+        client._count("operations.get")
+        with client._lock:
+            ready_at = client._render_ready_at.get(operation.name)
+        if ready_at is None:
+            raise KeyError(f"Unknown operation {operation.name}")
+        return FakeOperation(operation.name, time.monotonic() >= ready_at, client.sample_video)
+
+
+class FakeFiles:
+    # Chunk size of the real SDK's streaming download
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, client):
+        self._client = client
+
+    def download(self, *, file, destination=None):
+        """Stream the sample clip to `destination` in chunks, or return it as bytes."""
+        self._client._count("files.download")
+        with open(file.sample_video, 'rb') as f:
+            if destination is None:
+                return f.read()
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                destination.write(chunk)
+        return None
+
+
+class FakeGenaiClient:
+    """Offline genai.Client with fixed latencies and canned responses."""
+
+    def __init__(self, sample_video, text_latency=0.0, render_latency=0.0, idea_candidates=3):
+        self.sample_video = sample_video
+        self.text_latency = text_latency
+        self.render_latency = render_latency
+        self.idea_candidates = idea_candidates
+        self.metadata = {
+            "title": "Benchmark Float with Zesty! 🍹 #shorts",
+            "description": "Zesty makes a fizzy float in 8 seconds. #shorts #food #recipe",
+            "keywords": [f"benchmark keyword {n}" for n in range(40)],
+        }
+        self.calls = {}
+        self.models = FakeModels(self)
+        self.operations = FakeOperations(self)
+        self.files = FakeFiles(self)
+        self._items = itertools.count(1)
+        self._operations = itertools.count(1)
+        self._render_ready_at = {}
+        self._lock = threading.Lock()
+
+    def _count(self, call):
+        with self._lock:
+            self.calls[call] = self.calls.get(call, 0) + 1